@@ -0,0 +1,202 @@
+"""
+
+    Benchmark runner.
+
+    Author: Explore Data Science Academy.
+
+    Description: Generates a synthetic data set per scale in a scratch
+    workspace, runs every benchmark stage there in a fresh process (once
+    timed and once with allocation tracing) and writes the measurements,
+    with the commit and machine they were taken on, to a JSON file:
+
+        python -m benchmarks.run --scales 100k 1m --output before.json
+        python -m benchmarks.run --scales 100k 1m --compare before.json
+
+    Everything runs offline. The workspace starts without any model, so
+    the stages run in pipeline order, each one building the artifacts the
+    next ones load.
+
+"""
+# Script dependencies
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+from benchmarks.synthetic import generate, parse_scale
+from benchmarks.stages import STAGES
+
+# Repository root, added to the import path of the stage processes
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def commit():
+    """Commit of the repository, or None outside of a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def prepare(workspace, n_ratings, seed=0):
+    """Generate the data set of a scale into a workspace, reusing earlier
+       data of the same scale, and remove every model built from it.
+    """
+    data_dir = os.path.join(workspace, 'resources', 'data')
+    marker = os.path.join(data_dir, 'synthetic.json')
+    sizes = None
+    if os.path.exists(marker):
+        with open(marker) as f:
+            sizes = json.load(f)
+    if sizes is None or sizes.get('requested') != n_ratings or sizes.get('seed') != seed:
+        shutil.rmtree(data_dir, ignore_errors=True)
+        sizes = generate(data_dir, n_ratings, seed=seed)
+        sizes['requested'] = n_ratings
+        with open(marker, 'w') as f:
+            json.dump(sizes, f)
+    shutil.rmtree(os.path.join(data_dir, 'cache'), ignore_errors=True)
+    models_dir = os.path.join(workspace, 'resources', 'models')
+    shutil.rmtree(models_dir, ignore_errors=True)
+    os.makedirs(models_dir)
+    return sizes
+
+def run_stage(workspace, name, repeat, trace=False, timeout=None):
+    """Run one stage in a fresh process within the workspace.
+
+    Returns
+    -------
+    dict
+        Measurements printed by `benchmarks.stages`, or the error of a
+        failed stage.
+
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    # Results must be computed, not read from a persistent cache
+    env.pop('RECOMMENDER_CACHE_PATH', None)
+    command = [sys.executable, '-m', 'benchmarks.stages', name, '--repeat', str(repeat)]
+    if trace:
+        command.append('--trace')
+    try:
+        process = subprocess.run(command, cwd=workspace, env=env, capture_output=True,
+                                 text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return dict(stage=name, error=f'timed out after {timeout} s')
+    if process.returncode != 0:
+        return dict(stage=name, error=process.stderr.strip().splitlines()[-1:])
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+def run(scales, stages=None, repeat=3, trace=True, workspace=None, timeout=None, seed=0):
+    """Run the benchmark stages at every scale.
+
+    Parameters
+    ----------
+    scales : list (str)
+        Named scales ('100k', '1m', '10m', '25m') or numbers of ratings.
+    stages : list (str)
+        Stages to run, in pipeline order, defaults to all of them.
+        Serving stages need the artifacts of the build stages.
+    repeat : int
+        Number of warm runs of the serving stages.
+    trace : bool
+        Also run every stage with allocation tracing, in a separate
+        process so that tracing does not slow down the timed run.
+    workspace : str
+        Scratch directory, kept between runs so that synthetic data is
+        generated once per scale. Defaults to a temporary directory,
+        removed afterwards.
+    timeout : float
+        Largest number of seconds a stage may run.
+    seed : int
+        Seed of the synthetic data.
+
+    Returns
+    -------
+    dict
+        Environment of the run and the measurements of every stage at
+        every scale.
+
+    """
+    stages = stages or list(STAGES)
+    temporary = workspace is None
+    workspace = workspace or tempfile.mkdtemp(prefix='recommender-bench-')
+    report = dict(commit=commit(), created=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                  python=platform.python_version(), numpy=np.__version__,
+                  platform=platform.platform(), cpus=os.cpu_count(), results=[])
+    try:
+        for scale in scales:
+            sizes = prepare(workspace, parse_scale(scale), seed)
+            print(f"{scale}: {sizes['n_ratings']} ratings, {sizes['n_users']} users, "
+                  f"{sizes['n_movies']} movies")
+            for name in stages:
+                result = run_stage(workspace, name, repeat, timeout=timeout)
+                if trace and 'error' not in result:
+                    traced = run_stage(workspace, name, 0, trace=True, timeout=timeout)
+                    result['alloc_peak_mb'] = traced.get('alloc_peak_mb')
+                result.update(scale=scale, **sizes)
+                report['results'].append(result)
+                print(format_result(result))
+    finally:
+        if temporary:
+            shutil.rmtree(workspace, ignore_errors=True)
+    return report
+
+def format_result(result):
+    if 'error' in result:
+        return f"  {result['stage']:<20} failed: {result['error']}"
+    warm = result['warm_median_s']
+    return (f"  {result['stage']:<20} cold {result['cold_s']:9.3f} s"
+            + (f"  warm {warm:9.4f} s" if warm is not None else ' ' * 18)
+            + (f"  peak RSS {result['peak_rss_mb']:8.1f} MiB"
+               if result.get('peak_rss_mb') is not None else '')
+            + (f"  alloc {result['alloc_peak_mb']:8.1f} MiB"
+               if result.get('alloc_peak_mb') is not None else ''))
+
+def compare(before, after):
+    """Print the ratio of every measurement of `after` to `before`
+       (above 1 is slower or larger).
+    """
+    previous = {(r['scale'], r['stage']): r for r in before['results'] if 'error' not in r}
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    for result in after['results']:
+        old = previous.get((result['scale'], result['stage']))
+        if old is None or 'error' in result:
+            continue
+        ratios = []
+        for key in ('cold_s', 'warm_median_s', 'peak_rss_mb', 'alloc_peak_mb'):
+            if old.get(key) and result.get(key) is not None:
+                ratios.append(f"{key} x{result[key] / old[key]:.2f}")
+        print(f"  {result['scale']:<5} {result['stage']:<20} " + '  '.join(ratios))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the recommender pipeline.")
+    parser.add_argument('--scales', nargs='+', default=['100k'])
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-trace', action='store_true')
+    parser.add_argument('--workspace', default=None)
+    parser.add_argument('--timeout', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help="results file, defaults to benchmarks/results/<commit>.json")
+    parser.add_argument('--compare', default=None, help="earlier results file to compare with")
+    args = parser.parse_args(argv)
+
+    report = run(args.scales, args.stages, args.repeat, not args.no_trace,
+                 args.workspace, args.timeout, args.seed)
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results',
+                                         f"{(report['commit'] or 'local')[:12]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to: {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == '__main__':
+    main()
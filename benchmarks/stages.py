@@ -0,0 +1,207 @@
+"""
+
+    Benchmark stages.
+
+    Author: Explore Data Science Academy.
+
+    Description: Every stage is one unit of work of the recommender
+    pipeline, from converting the CSV files to serving recommendations.
+    A stage is run in a fresh process whose working directory holds the
+    `resources` folder of a (synthetic) data set, see `benchmarks.run`:
+
+        python -m benchmarks.stages collab_model --repeat 5
+
+    The first call is timed as the cold run, including the imports and
+    every file the stage loads, and the following calls as warm runs.
+    Stages which build artifacts for the later stages are only run cold.
+    The measurements are printed as one line of JSON.
+
+"""
+# Script dependencies
+import os
+import sys
+import json
+import time
+import argparse
+import importlib.util
+import tracemalloc
+import numpy as np
+from utils.instrumentation import peak_rss_mb
+
+# Repository root, for the training scripts under resources/models
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Smaller models than the served ones, so that training stays affordable
+# at the largest scales
+TRAIN_PARAMS = dict(n_factors=50, n_epochs=10)
+
+# Number of users of the batch stages
+BATCH_USERS = 10_000
+
+# Every stage, by name, in pipeline order, see `stage`
+STAGES = {}
+# Stages building artifacts, which are only run cold
+BUILD_STAGES = set()
+
+def stage(name, build=False):
+    """Register a function of a random generator as a benchmark stage."""
+    def decorator(func):
+        STAGES[name] = func
+        if build:
+            BUILD_STAGES.add(name)
+        return func
+    return decorator
+
+def load_script(name):
+    """Import one of the training scripts of resources/models."""
+    path = os.path.join(ROOT, 'resources', 'models', name + '.py')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def seed_titles(rng, movie_ids, n=3):
+    """Titles of random movies among the given IDs."""
+    from utils.data_loader import load_catalogue
+    catalogue = load_catalogue()
+    movie_ids = np.asarray(movie_ids)
+    movie_ids = movie_ids[catalogue.rows(movie_ids) >= 0]
+    return catalogue.titles_for_ids(rng.choice(movie_ids, n, replace=False))
+
+@stage('convert_data', build=True)
+def convert_data(rng):
+    from utils.data_loader import convert_movies, convert_ratings
+    convert_movies()
+    convert_ratings()
+
+@stage('data_preprocessing')
+def data_preprocessing(rng):
+    from recommenders.content_based import data_preprocessing, SUBSET_SIZE
+    data_preprocessing(SUBSET_SIZE)
+
+@stage('content_index', build=True)
+def content_index(rng):
+    from recommenders.content_based import build_content_index, build_content_neighbours
+    count_matrix, _ = build_content_index()
+    build_content_neighbours(count_matrix)
+
+@stage('train_svd', build=True)
+def train_svd(rng):
+    load_script('train_colbased').svd_pp('resources/models/svd_model.pkl',
+                                         'resources/models/svd_factors',
+                                         TRAIN_PARAMS, 'resources/data/ratings.csv')
+
+@stage('train_als', build=True)
+def train_als(rng):
+    load_script('train_als').als('resources/data/ratings.csv', 'resources/models/als_factors',
+                                 verbose=False, **TRAIN_PARAMS)
+
+@stage('collab_index', build=True)
+def collab_index(rng):
+    script = load_script('build_colbased_index')
+    script.item_neighbours('resources/models/svd_factors', 'resources/models')
+    script.ann_index('resources/models/svd_factors', 'resources/models/svd_ann.npz')
+
+@stage('content_model')
+def content_model(rng):
+    from recommenders.content_based import content_model, load_content_neighbours
+    from utils.data_loader import load_catalogue
+    from utils.result_cache import recommendation_cache
+    recommendation_cache.clear()
+    neighbours, _ = load_content_neighbours()
+    content_model(seed_titles(rng, load_catalogue().movie_ids[:len(neighbours)]), 10)
+
+@stage('collab_model')
+def collab_model(rng):
+    from recommenders.collaborative_based import collab_model, get_factors
+    from utils.result_cache import recommendation_cache
+    recommendation_cache.clear()
+    collab_model(seed_titles(rng, get_factors().item_ids), 10)
+
+@stage('hybrid_model')
+def hybrid_model(rng):
+    from recommenders.hybrid import hybrid_model
+    from recommenders.collaborative_based import get_factors
+    from utils.result_cache import recommendation_cache
+    recommendation_cache.clear()
+    hybrid_model(seed_titles(rng, get_factors().item_ids), 10)
+
+@stage('collab_cold_start')
+def collab_cold_start(rng):
+    # Fallback of collab_model when the model knows none of the chosen movies
+    from recommenders.collaborative_based import collab_from_factors, get_factors
+    collab_from_factors(rng.choice(get_factors().item_ids, 3).tolist(), 10)
+
+@stage('content_batch')
+def content_batch(rng):
+    from recommenders.content_based import content_batch, load_content_neighbours
+    from utils.data_loader import load_catalogue
+    neighbours, _ = load_content_neighbours()
+    movie_ids = load_catalogue().movie_ids[:len(neighbours)]
+    for _ in content_batch(rng.choice(movie_ids, (BATCH_USERS, 3)).tolist()):
+        pass
+
+@stage('collab_batch')
+def collab_batch(rng):
+    from recommenders.collaborative_based import collab_batch, get_factors
+    for _ in collab_batch(rng.choice(get_factors().item_ids, (BATCH_USERS, 3)).tolist()):
+        pass
+
+def measure(name, repeat=3, trace=False, seed=0):
+    """Run a stage once cold and `repeat` times warm.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    repeat : int
+        Number of warm runs, ignored for stages building artifacts.
+    trace : bool
+        Trace Python and NumPy allocations of the cold run with
+        `tracemalloc`. Tracing slows the run down, so its timings should
+        not be compared with untraced ones.
+    seed : int
+        Seed of the random seed movies.
+
+    Returns
+    -------
+    dict
+        Wall times in seconds, peak RSS in MiB (before and after the
+        stage) and, when traced, the peak of traced allocations in MiB.
+
+    """
+    func = STAGES[name]
+    if name in BUILD_STAGES:
+        repeat = 0
+    rng = np.random.default_rng(seed)
+    result = dict(stage=name, baseline_rss_mb=peak_rss_mb())
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    func(rng)
+    result['cold_s'] = time.perf_counter() - start
+    if trace:
+        result['alloc_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    warm = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(rng)
+        warm.append(time.perf_counter() - start)
+    result['warm_s'] = warm
+    result['warm_median_s'] = float(np.median(warm)) if warm else None
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run one benchmark stage.")
+    parser.add_argument('stage', choices=list(STAGES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--trace', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    result = measure(args.stage, args.repeat, args.trace, args.seed)
+    print(json.dumps(result))
+
+if __name__ == '__main__':
+    main()
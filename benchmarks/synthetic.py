@@ -0,0 +1,156 @@
+"""
+
+    Synthetic MovieLens-like data for benchmarks.
+
+    Author: Explore Data Science Academy.
+
+    Description: Generates `movies.csv`, `ratings.csv`, `tags.csv` and
+    `imdb_data.csv` with the columns of the MovieLens files used by the
+    app, at any number of ratings. Movie popularity and user activity are
+    long-tailed, and ratings follow a low-rank model plus noise, so that
+    the recommenders have some structure to learn.
+
+        python -m benchmarks.synthetic --ratings 1000000 --output data/
+
+"""
+# Script dependencies
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+# Named scales, in number of ratings
+SCALES = {'100k': 100_000, '1m': 1_000_000, '10m': 10_000_000, '25m': 25_000_000}
+
+GENRES = ['Action', 'Adventure', 'Animation', 'Children', 'Comedy', 'Crime',
+          'Documentary', 'Drama', 'Fantasy', 'Film-Noir', 'Horror', 'IMAX',
+          'Musical', 'Mystery', 'Romance', 'Sci-Fi', 'Thriller', 'War', 'Western']
+
+def parse_scale(scale):
+    """Number of ratings of a named scale ('1m') or a plain number."""
+    return SCALES[scale] if scale in SCALES else int(float(scale))
+
+def default_sizes(n_ratings):
+    """Numbers of users and movies of a scale, close to the MovieLens
+       releases (671 users and 9k movies for 100k ratings, 162k users
+       and 62k movies for 25M ratings).
+    """
+    n_users = max(600, n_ratings // 150)
+    n_movies = min(62_000, max(9_000, n_ratings // 400))
+    return n_users, n_movies
+
+def words(rng, vocabulary, n, low, high):
+    """Join `low` to `high` random words of a vocabulary with '|', n times."""
+    counts = rng.integers(low, high + 1, n)
+    picks = rng.integers(0, len(vocabulary), counts.sum())
+    return ['|'.join(group) for group in np.split(np.asarray(vocabulary)[picks], np.cumsum(counts)[:-1])]
+
+def generate(directory, n_ratings, n_users=None, n_movies=None, n_factors=8,
+             chunk_size=1_000_000, seed=0):
+    """Write a synthetic MovieLens-like data set.
+
+    Parameters
+    ----------
+    directory : str
+        Directory the CSV files are written to, created if missing.
+    n_ratings : int
+        Number of ratings to draw. Repeated (user, movie) pairs are
+        dropped, so slightly fewer ratings are written.
+    n_users : int
+        Number of users, see `default_sizes`.
+    n_movies : int
+        Number of movies, see `default_sizes`.
+    n_factors : int
+        Rank of the model the ratings are drawn from.
+    chunk_size : int
+        Number of ratings drawn at once, bounding memory use.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    dict
+        Number of users, movies, ratings and tags written.
+
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    default_users, default_movies = default_sizes(n_ratings)
+    n_users = n_users or default_users
+    n_movies = n_movies or default_movies
+
+    # Movies, with gaps in their IDs as in MovieLens
+    movie_ids = np.sort(rng.choice(np.arange(1, 3 * n_movies), n_movies, replace=False))
+    years = rng.integers(1920, 2020, n_movies)
+    movies = pd.DataFrame({'movieId': movie_ids,
+                           'title': [f'Synthetic Movie {i} ({y})' for i, y in zip(movie_ids, years)],
+                           'genres': words(rng, GENRES, n_movies, 1, 3)})
+    movies.to_csv(os.path.join(directory, 'movies.csv'), index=False)
+
+    # Long-tailed popularity and activity, and the low-rank rating model
+    popularity = 1 / np.arange(1, n_movies + 1) ** 0.8
+    popularity = rng.permutation(popularity / popularity.sum())
+    activity = rng.lognormal(0, 1.2, n_users)
+    activity /= activity.sum()
+    pu = rng.normal(0, 0.4, (n_users, n_factors))
+    qi = rng.normal(0, 0.4, (n_movies, n_factors))
+    bu = rng.normal(0, 0.3, n_users)
+    bi = rng.normal(0, 0.5, n_movies)
+
+    users = rng.choice(n_users, n_ratings, p=activity).astype(np.int64)
+    items = rng.choice(n_movies, n_ratings, p=popularity).astype(np.int64)
+    _, first = np.unique(users * n_movies + items, return_index=True)
+    first.sort()
+    users, items = users[first], items[first]
+    ratings = np.empty(len(users), dtype=np.float32)
+    for start in range(0, len(users), chunk_size):
+        u, i = users[start:start + chunk_size], items[start:start + chunk_size]
+        est = 3.5 + bu[u] + bi[i] + np.einsum('ij,ij->i', pu[u], qi[i]) + rng.normal(0, 0.8, len(u))
+        ratings[start:start + chunk_size] = np.clip(np.round(est * 2) / 2, 0.5, 5)
+    timestamps = rng.integers(789_652_009, 1_574_327_703, len(users))
+    pd.DataFrame({'userId': users + 1, 'movieId': movie_ids[items], 'rating': ratings,
+                  'timestamp': timestamps}).to_csv(os.path.join(directory, 'ratings.csv'),
+                                                   index=False)
+
+    # Tags on a sample of the rated movies
+    vocabulary = [f'tag{i}' for i in range(500)]
+    tagged = rng.choice(len(users), max(1, len(users) // 25), replace=False)
+    pd.DataFrame({'userId': users[tagged] + 1, 'movieId': movie_ids[items[tagged]],
+                  'tag': words(rng, vocabulary, len(tagged), 1, 1),
+                  'timestamp': timestamps[tagged]}).to_csv(
+                      os.path.join(directory, 'tags.csv'), index=False)
+
+    # IMDb metadata, with missing directors as in the real file
+    actors = [f'Actor {i}' for i in range(max(2000, n_movies // 4))]
+    directors = np.array([f'Director {i}' for i in range(max(500, n_movies // 20))], dtype=object)
+    director = directors[rng.integers(0, len(directors), n_movies)]
+    director[rng.random(n_movies) < 0.1] = None
+    pd.DataFrame({'movieId': movie_ids,
+                  'title_cast': words(rng, actors, n_movies, 2, 5),
+                  'director': director,
+                  'runtime': rng.integers(70, 200, n_movies),
+                  'budget': [f'${b:,}' for b in rng.integers(1, 200, n_movies) * 1_000_000],
+                  'plot_keywords': words(rng, vocabulary, n_movies, 2, 5)}).to_csv(
+                      os.path.join(directory, 'imdb_data.csv'), index=False)
+
+    sizes = dict(n_users=int(n_users), n_movies=int(n_movies), n_ratings=int(len(users)),
+                 n_tags=int(len(tagged)), seed=seed)
+    with open(os.path.join(directory, 'synthetic.json'), 'w') as f:
+        json.dump(sizes, f)
+    return sizes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic MovieLens-like CSV files.")
+    parser.add_argument('--ratings', default='100k',
+                        help="number of ratings, or one of " + ', '.join(SCALES))
+    parser.add_argument('--users', type=int, default=None)
+    parser.add_argument('--movies', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='.')
+    args = parser.parse_args(argv)
+    print(generate(args.output, parse_scale(args.ratings), args.users, args.movies,
+                   seed=args.seed))
+
+if __name__ == '__main__':
+    main()
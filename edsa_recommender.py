@@ -26,6 +26,7 @@
 
 """
 # Streamlit dependencies
+import os
 import streamlit as st
 
 # Data handling dependencies
@@ -34,18 +35,57 @@ import numpy as np
 
 # Custom Libraries
 from utils.data_loader import load_movie_titles
-from recommenders.collaborative_based import collab_model
-from recommenders.content_based import content_model
+from utils.registry import preload, readiness
+from utils import instrumentation
+
+# Address ('host:port') of a running recommenders.server, which then
+# computes the recommendations of every session in shared batches
+RECOMMENDER_SERVER = os.environ.get('RECOMMENDER_SERVER')
+
+# The recommenders, their models and their heavy dependencies are only
+# loaded once an algorithm is first used, and are then shared by every
+# session and rerun of this process. Each call is recorded as one
+# request by the instrumentation, when enabled.
+def collab_model(movie_list, top_n=10):
+    with instrumentation.request('collab_model'):
+        if RECOMMENDER_SERVER:
+            from recommenders.server import recommend
+            return recommend('collab', movie_list, top_n, RECOMMENDER_SERVER)
+        from recommenders.collaborative_based import collab_model
+        return collab_model(movie_list, top_n)
+
+def content_model(movie_list, top_n=10):
+    with instrumentation.request('content_model'):
+        if RECOMMENDER_SERVER:
+            from recommenders.server import recommend
+            return recommend('content', movie_list, top_n, RECOMMENDER_SERVER)
+        from recommenders.content_based import content_model
+        return content_model(movie_list, top_n)
+
+# The hybrid recommender is always computed in this process
+def hybrid_model(movie_list, top_n=10, weights=(0.5, 0.5)):
+    with instrumentation.request('hybrid_model'):
+        from recommenders.hybrid import hybrid_model
+        return hybrid_model(movie_list, top_n, weights=weights)
 
 # Data Loading
 title_list = load_movie_titles('resources/data/movies.csv')
 
+# Load both recommenders in the background while the first page is served,
+# unless they are served by the recommendation server. The hybrid
+# recommender is only loaded once its page is first opened.
+ALGORITHM_GROUPS = {'Content Based Filtering': 'content',
+                    'Collaborative Based Filtering': 'collab'}
+if not RECOMMENDER_SERVER:
+    preload('content', 'recommenders.content_based')
+    preload('collab', 'recommenders.collaborative_based')
+
 # App declaration
 def main():
 
     # DO NOT REMOVE the 'Recommender System' option below, however,
     # you are welcome to add more options to enrich your app.
-    page_options = ["Recommender System", "Insights","About Recommenders","Our Team"]
+    page_options = ["Recommender System", "Hybrid Recommender", "Insights","About Recommenders","Our Team"]
 
     # -------------------------------------------------------------------
     # ----------- !! THIS CODE MUST NOT BE ALTERED !! -------------------
@@ -102,6 +142,72 @@ def main():
     # -------------------------------------------------------------------
 
     # ------------- SAFE FOR ALTERING/EXTENSION -------------------
+    if page_selection == "Recommender System":
+        st.sidebar.markdown("**Model status**")
+        if RECOMMENDER_SERVER:
+            st.sidebar.text(f"Served by {RECOMMENDER_SERVER}")
+        else:
+            for algorithm, group in ALGORITHM_GROUPS.items():
+                st.sidebar.text(f"{algorithm}: {readiness(group)}")
+
+        # Stage breakdown of the last recommendation served by this process
+        if instrumentation.enabled and st.sidebar.checkbox("Show timing breakdown"):
+            last_request = instrumentation.last_request
+            if last_request is None:
+                st.info("No recommendation has been made yet.")
+            else:
+                st.write(f"### Timing breakdown: {last_request['request']}")
+                st.table(pd.DataFrame(
+                    {'stage': ['\u2003' * s['depth'] + s['name'] for s in last_request['spans']],
+                     'ms': [round(s['ms'], 3) for s in last_request['spans']],
+                     'peak RSS growth (MiB)': [None if s['peak_rss_growth_mb'] is None
+                                               else round(s['peak_rss_growth_mb'], 1)
+                                               for s in last_request['spans']]}))
+                snapshot = instrumentation.snapshot()
+                st.write(snapshot['counters'])
+                # Latency histograms of every stage since the app started
+                st.write("### Latency by stage")
+                histograms = snapshot['histograms']
+                st.table(pd.DataFrame(
+                    {'stage': list(histograms),
+                     'calls': [h['count'] for h in histograms.values()],
+                     'mean ms': [round(h['sum_ms'] / h['count'], 3) for h in histograms.values()],
+                     'p50 ms \u2264': [instrumentation.quantile(h, 0.5) for h in histograms.values()],
+                     'p95 ms \u2264': [instrumentation.quantile(h, 0.95)
+                                       for h in histograms.values()]}))
+                stage = st.selectbox("Histogram of stage", sorted(histograms))
+                # Buckets are numbered to keep them in order on the chart
+                st.bar_chart(pd.DataFrame(
+                    {'calls': histograms[stage]['buckets']},
+                    index=[f"{i:02d}: \u2264 {bound} ms"
+                           for i, bound in enumerate(snapshot['buckets_ms'])]))
+
+    if page_selection == "Hybrid Recommender":
+        preload('hybrid', 'recommenders.hybrid')
+        st.sidebar.markdown("**Model status**")
+        st.sidebar.text(f"Hybrid: {readiness('hybrid')}")
+        st.write('# Hybrid Recommender Engine')
+        st.write('Blends the content-based and collaborative similarity of movies '
+                 'to your three favourites.')
+        content_weight = st.slider('Weight of content-based similarity',
+                                   min_value=0.0, max_value=1.0, value=0.5, step=0.05)
+        st.write('### Enter Your Three Favorite Movies')
+        movie_1 = st.selectbox('First Option',title_list[14930:15200])
+        movie_2 = st.selectbox('Second Option',title_list[25055:25255])
+        movie_3 = st.selectbox('Third Option',title_list[21100:21200])
+        fav_movies = [movie_1,movie_2,movie_3]
+        if st.button("Recommend"):
+            try:
+                with st.spinner('Crunching the numbers...'):
+                    top_recommendations = hybrid_model(movie_list=fav_movies, top_n=10,
+                                                       weights=(content_weight, 1 - content_weight))
+                st.title("We think you'll like:")
+                for i,j in enumerate(top_recommendations):
+                    st.subheader(str(i+1)+'. '+j)
+            except:
+                st.error("Oops! Looks like this algorithm does't work.\
+                    We'll need to fix it!")
+
     if page_selection == "About Recommenders":
   
         st.title("About Recommenders")
@@ -0,0 +1,250 @@
+"""
+
+    Approximate nearest neighbour search over item factors.
+
+    Author: Explore Data Science Academy.
+
+    Description: Provided within this file is a pure-NumPy inverted file
+    (IVF) index. Items are partitioned with a spherical k-means coarse
+    quantiser, and a query is only scored exactly against the items of
+    its closest partitions, which keeps search cost roughly constant as
+    the catalogue grows.
+
+"""
+
+# Script dependencies
+import os
+import time
+import numpy as np
+from utils.ranking import top_k
+
+def unit_rows(vectors):
+    """L2-normalise the rows of a matrix, leaving zero rows untouched."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+class IVFIndex:
+    """Inverted file index for max-inner-product / cosine search.
+
+    Parameters
+    ----------
+    centroids : numpy.ndarray
+        Unit-length partition centroids.
+    offsets : numpy.ndarray
+        Start of every partition within `order`, plus the total count.
+    order : numpy.ndarray
+        Item row of every stored vector, grouped by partition.
+    vectors : numpy.ndarray
+        Item vectors, in `order`.
+    item_ids : numpy.ndarray
+        Raw movie ID of every item row.
+    source : str
+        Fingerprint of the model the vectors were taken from, empty when
+        unknown.
+    n_probe : int
+        Default number of partitions scanned per query, see `tune`.
+    recall : float or None
+        Recall@10 measured at `n_probe`, None when not measured.
+
+    """
+
+    def __init__(self, centroids, offsets, order, vectors, item_ids, source='', n_probe=8,
+                 recall=None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.order = order
+        self.vectors = vectors
+        self.item_ids = item_ids
+        self.source = source
+        self.n_probe = n_probe
+        self.recall = recall
+        self.position = np.empty_like(order)
+        self.position[order] = np.arange(len(order))
+
+    @classmethod
+    def build(cls, vectors, item_ids, n_lists=None, n_iter=20, normalise=True,
+              chunk_size=65536, seed=0, source=''):
+        """Partition item vectors with spherical k-means.
+
+        Parameters
+        ----------
+        vectors : numpy.ndarray
+            One vector per item, e.g. SVD item factors `qi`.
+        item_ids : array-like
+            Raw movie ID of every vector.
+        n_lists : int
+            Number of partitions, sqrt(n) by default.
+        n_iter : int
+            Number of k-means iterations.
+        normalise : bool
+            Store unit vectors (cosine search) rather than the raw vectors
+            (inner product search).
+        chunk_size : int
+            Number of vectors assigned to partitions at once.
+        seed : int
+            Seed of the centroid initialisation.
+        source : str
+            Fingerprint of the model the vectors come from.
+
+        Returns
+        -------
+        IVFIndex
+            The built index.
+
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        units = unit_rows(vectors)
+        n = len(units)
+        n_lists = min(n_lists or max(1, int(np.sqrt(n))), n)
+        rng = np.random.default_rng(seed)
+        centroids = units[rng.choice(n, n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = cls.assign(units, centroids, chunk_size)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, units)
+            counts = np.bincount(assignment, minlength=n_lists)
+            # Empty partitions restart from a random item
+            empty = counts == 0
+            sums[empty] = units[rng.choice(n, empty.sum())]
+            centroids = unit_rows(sums)
+        assignment = cls.assign(units, centroids, chunk_size)
+        order = np.argsort(assignment, kind='stable').astype(np.int32)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+        stored = units if normalise else vectors
+        return cls(centroids, offsets, order, stored[order], np.asarray(item_ids), source)
+
+    @staticmethod
+    def assign(units, centroids, chunk_size):
+        """Closest centroid of every unit vector, computed in chunks."""
+        assignment = np.empty(len(units), dtype=np.int64)
+        for start in range(0, len(units), chunk_size):
+            block = units[start:start + chunk_size] @ centroids.T
+            assignment[start:start + chunk_size] = block.argmax(axis=1)
+        return assignment
+
+    def save(self, path):
+        """Persist the index as a single .npz file.
+
+        The file is written aside and then renamed over `path`, so that a
+        process loading the index meanwhile reads the previous one whole.
+        """
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, centroids=self.centroids, offsets=self.offsets,
+                 order=self.order, vectors=self.vectors, item_ids=self.item_ids,
+                 source=np.array(self.source), n_probe=self.n_probe,
+                 recall=np.nan if self.recall is None else self.recall)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by `save`."""
+        with np.load(path) as data:
+            # Indexes saved without a source are of an unknown model, and
+            # without a recall were never tuned
+            source = str(data['source']) if 'source' in data else ''
+            n_probe = int(data['n_probe']) if 'n_probe' in data else 8
+            recall = float(data['recall']) if 'recall' in data else np.nan
+            return cls(data['centroids'], data['offsets'], data['order'],
+                       data['vectors'], data['item_ids'], source, n_probe,
+                       None if np.isnan(recall) else recall)
+
+    def vector(self, rows):
+        """Stored vectors of the given item rows."""
+        return self.vectors[self.position[rows]]
+
+    def search(self, queries, k, n_probe=None):
+        """Find the items with the highest inner product with each query.
+
+        Parameters
+        ----------
+        queries : numpy.ndarray
+            One query vector per row.
+        k : int
+            Number of items to return per query.
+        n_probe : int
+            Number of partitions scanned per query, `self.n_probe` by
+            default. Higher values trade speed for recall.
+
+        Returns
+        -------
+        tuple (numpy.ndarray, numpy.ndarray)
+            Item rows (-1 when fewer than k items were scanned) and scores
+            (-inf likewise) of shape len(queries) x k, best first.
+
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        probes = top_k(queries @ self.centroids.T, n_probe or self.n_probe)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, (query, probe) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([np.arange(self.offsets[p], self.offsets[p + 1])
+                                         for p in probe])
+            candidate_scores = self.vectors[candidates] @ query
+            best = top_k(candidate_scores, k)
+            rows[q, :len(best)] = self.order[candidates[best]]
+            scores[q, :len(best)] = candidate_scores[best]
+        return rows, scores
+
+def benchmark(index, k=10, n_probe=None, n_queries=1000, seed=0):
+    """Compare the index against exact (brute-force) search.
+
+    Queries are stored item vectors, so each query's own item is part of
+    both result sets.
+
+    Parameters
+    ----------
+    index : IVFIndex
+        Index to evaluate.
+    k : int
+        Number of neighbours per query.
+    n_probe : int
+        Number of partitions scanned per query, `index.n_probe` by default.
+    n_queries : int
+        Number of item vectors sampled as queries.
+    seed : int
+        Seed of the query sample.
+
+    Returns
+    -------
+    dict
+        Mean recall@k and the mean latency per query (ms) of both searches.
+
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(index.order), min(n_queries, len(index.order)), replace=False)
+    queries = index.vector(rows)
+    start = time.perf_counter()
+    exact = np.concatenate([index.order[top_k(block @ index.vectors.T, k)]
+                            for block in np.array_split(queries, max(1, len(queries) // 100))])
+    exact_time = time.perf_counter() - start
+    start = time.perf_counter()
+    approx, _ = index.search(queries, k, n_probe)
+    ann_time = time.perf_counter() - start
+    hits = [len(np.intersect1d(e, a)) for e, a in zip(exact, approx)]
+    return {'recall': float(np.mean(hits)) / k,
+            'exact_ms': 1000 * exact_time / len(rows),
+            'ann_ms': 1000 * ann_time / len(rows)}
+
+def tune(index, target_recall=0.9, k=10, n_queries=1000, seed=0):
+    """Set the default probe count of an index from its measured recall.
+
+    The number of partitions scanned is doubled, from 8, until recall@k
+    reaches `target_recall` or every partition is scanned (exact search).
+    The chosen count and its recall are stored on the index.
+
+    Returns
+    -------
+    dict
+        Benchmark of the chosen probe count, see `benchmark`, with its
+        `n_probe`.
+
+    """
+    n_lists = len(index.centroids)
+    n_probe = min(8, n_lists)
+    while True:
+        result = benchmark(index, k, n_probe, n_queries, seed)
+        if result['recall'] >= target_recall or n_probe == n_lists:
+            break
+        n_probe = min(2 * n_probe, n_lists)
+    index.n_probe, index.recall = n_probe, result['recall']
+    return dict(result, n_probe=n_probe)
@@ -23,11 +23,16 @@
     ---------------------------------------------------------------------
 
     Description: Provided within this file is a baseline collaborative
-    filtering algorithm for rating predictions on Movie data.
+    filtering algorithm for rating predictions on Movie data. Movies are
+    recommended by the cosine similarity of their SVD item factors to the
+    closest chosen movie, see `collab_model` for where each request is
+    served from.
 
 """
 
 # Script dependencies
+import os
+import json
 import pandas as pd
 import numpy as np
 import scipy as sp
@@ -37,149 +42,457 @@ import pickle
 import copy
 from surprise import Reader, Dataset
 from surprise import SVD, NormalPredictor, BaselineOnly, KNNBasic, NMF
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.feature_extraction.text import CountVectorizer
-from utils.data_loader import load_movie_titles
-
-# Importing data
-movies_df = pd.read_csv('resources/data/movies.csv')
-ratings_df = pd.read_csv('resources/data/ratings.csv')
-ratings_df.drop(['timestamp'], axis=1,inplace=True)
+from utils.data_loader import load_movie_titles, load_catalogue
+from utils.registry import resource
+from utils.instrumentation import timed
+from utils.result_cache import cached_recommendations, model_version
+from recommenders.warmup import warm_recommendations, WARMUP_PATH
+from utils.ranking import top_k, merge_neighbours, merge_neighbour_batch, stream_top_k
+from recommenders.factor_model import FactorModel
+from recommenders.ann_index import IVFIndex, unit_rows
 
 # We make use of an SVD model trained on a subset of the MovieLens 10k dataset.
-model=pickle.load(open('resources/models/svd_model.pkl', 'rb'))
+MODEL_PATH = 'resources/models/svd_model.pkl'
+# Parameters of the same model as memory-mapped arrays, see `FactorModel.save`
+FACTORS_DIR = 'resources/models/svd_factors'
+
+# Resources loaded in the background when the app starts. The ANN index
+# only serves requests the neighbour table cannot, see `collab_from_ann`,
+# and is loaded on first use.
+PRELOAD = ['warmup', 'svd_factors', 'collab_neighbours']
+
+@resource('svd_model')
+def load_svd_model():
+    """Unpickle the SVD model, once per process."""
+    return pickle.load(open(MODEL_PATH, 'rb'))
+
+@resource('svd_factors')
+def load_factors():
+    """NumPy view of the SVD model parameters for batched scoring.
+
+    The exported parameter bundle is memory-mapped when available, and
+    the pickled model is only unpickled otherwise.
+    """
+    global loaded_factors_mtime
+    loaded_factors_mtime = factors_mtime()
+    if FactorModel.exists(FACTORS_DIR):
+        return FactorModel.load(FACTORS_DIR)
+    return FactorModel.from_surprise(load_svd_model(), FactorModel.pickle_fingerprint(MODEL_PATH))
+
+# Version of the bundle `load_factors` last loaded, see `get_factors`
+loaded_factors_mtime = None
+
+def factors_mtime():
+    """Modification time of the exported model parameters, if any."""
+    manifest_path = os.path.join(FACTORS_DIR, 'manifest.json')
+    return os.stat(manifest_path).st_mtime_ns if os.path.exists(manifest_path) else None
+
+def get_factors():
+    """Get the process-wide model parameters, loading them on first use.
+
+    The parameters are reloaded whenever the exported bundle has been
+    modified since they were loaded, e.g. after new ratings were folded
+    into it.
+
+    Returns
+    -------
+    FactorModel
+        Shared model parameters.
+
+    """
+    factors = load_factors()
+    if loaded_factors_mtime != factors_mtime():
+        load_factors.cache_clear()
+        factors = load_factors()
+    return factors
+
+# Regularisation of the user fitted to the chosen movies, see `collab_from_factors`
+COLD_START_REG = 0.1
+
+@timed('collab.cold_start')
+def collab_from_factors(movie_ids, top_n):
+    """Rank movies for a new user who rated the chosen movies highly.
+
+    The factors and bias of the user are fitted to five-star ratings of
+    the chosen movies against the fixed item factors (regularised least
+    squares), and every movie is then scored with a single matrix-vector
+    product.
+
+    `collab_model` deliberately does not rank by this predicted rating
+    when the model knows a chosen movie. Every other source of its
+    answers (the warm-up lookups, the neighbour table, the ANN index,
+    the exact scan and the server's batches) ranks by item similarity,
+    so a request answered here would disagree with the same request
+    answered by an index, and the top 10 would not be a prefix of the
+    top 150. It is only used when the model knows none of the chosen
+    movies. The fitted factors are then zero and movies are ranked by
+    their bias, i.e. the best-rated movies overall.
+
+    Parameters
+    ----------
+    movie_ids : list (int)
+        Movie IDs of the chosen movies.
+    top_n : int
+        Number of movies to return.
+
+    Returns
+    -------
+    numpy.ndarray
+        Movie IDs of the highest scoring movies, best first. When the
+        model knows none of the chosen movies, movies are ranked by their
+        bias alone.
+
+    """
+    factors = get_factors()
+    pu, bu = factors.fold_in_user(movie_ids, np.full(len(movie_ids), 5.0), COLD_START_REG)
+    scores = factors.score_items(pu, bu)
+
+    # Removing chosen movies and movies missing from the movie titles
+    chosen = factors.item_rows(movie_ids)
+    scores[chosen[chosen >= 0]] = -np.inf
+    scores[load_catalogue().rows(factors.item_ids) < 0] = -np.inf
+    top_indexes = top_k(scores, top_n)
+    return factors.item_ids[top_indexes[np.isfinite(scores[top_indexes])]]
+
+# Precomputed collaborative neighbours, see resources/models/build_colbased_index.py.
+# The manifest names the current arrays and records the fingerprint of
+# the model they were computed from.
+NEIGHBOUR_MANIFEST_PATH = 'resources/models/collab_neighbours.json'
+
+@resource('collab_neighbours')
+def load_collab_neighbours():
+    """Memory-map the precomputed collaborative neighbour index.
+
+    The arrays are mapped read-only, so worker processes share their pages
+    through the OS page cache instead of each holding a copy.
+
+    Returns
+    -------
+    tuple (dict, numpy.memmap, numpy.memmap, numpy.memmap, str) or None
+        Row of every movie ID, the movie ID of every row, the neighbour
+        rows and scores of every row (best first) and the fingerprint of
+        the model they were computed from, or None if the index has not
+        been built.
+
+    """
+    if not os.path.exists(NEIGHBOUR_MANIFEST_PATH):
+        return None
+    with open(NEIGHBOUR_MANIFEST_PATH) as f:
+        manifest = json.load(f)
+    directory = os.path.dirname(NEIGHBOUR_MANIFEST_PATH)
+    item_ids, indices, scores = [np.load(os.path.join(directory, manifest['files'][key]),
+                                         mmap_mode='r')
+                                 for key in ('item_ids', 'indices', 'scores')]
+    rows = {movie_id: row for row, movie_id in enumerate(item_ids.tolist())}
+    return rows, item_ids, indices, scores, manifest['source']
+
+def current_index(loader):
+    """Value of an index loader, or None when the index is missing or was
+       built from other parameters than the current model's.
+
+    An index loaded before the model changed is reloaded once, in case it
+    has been rebuilt since.
+    """
+    fingerprint = get_factors().fingerprint
+    index = loader()
+    if index is not None and index[-1] != fingerprint:
+        loader.cache_clear()
+        index = loader()
+    return index if index is not None and index[-1] == fingerprint else None
+
+@timed('collab.merge')
+def collab_from_neighbours(movie_ids, top_n):
+    """Rank movies by merging the precomputed neighbours of the chosen movies.
+
+    Parameters
+    ----------
+    movie_ids : list (int)
+        Movie IDs of the chosen movies.
+    top_n : int
+        Number of movies to return.
+
+    Returns
+    -------
+    numpy.ndarray or None
+        Movie IDs of the most similar movies, best first, or None when the
+        index is missing or stale, knows none of the chosen movies or
+        holds too few neighbours for an exact answer.
+
+    """
+    index = current_index(load_collab_neighbours)
+    if index is None:
+        return None
+    rows, item_ids, indices, scores, _ = index
+    idx = [rows[movie_id] for movie_id in movie_ids if movie_id in rows]
+    if not idx:
+        return None
+    # Only the first k - len(idx) + 1 merged neighbours are the exact best
+    # (the others may be beaten by movies missing from every list)
+    exact = indices.shape[1] - len(idx) + 1
+    if top_n > exact:
+        return None
+    top_indexes, _ = merge_neighbours(indices[idx], scores[idx], exclude=idx, n=exact)
+    # Keeping movies which have a title
+    top_ids = item_ids[top_indexes]
+    top_ids = top_ids[load_catalogue().rows(top_ids) >= 0]
+    if len(top_ids) < top_n:
+        return None
+    return top_ids[:top_n]
+
+@timed('collab.merge_batch')
+def collab_neighbour_batch(seed_lists, top_ns):
+    """Answer many requests at once from the precomputed neighbours.
+
+    The neighbour rows of the chosen movies of every request are gathered
+    and merged together, ranking as `collab_from_neighbours` does.
+    Requests the index cannot answer exactly are left for `collab_batch`.
+
+    Parameters
+    ----------
+    seed_lists : list (list (int))
+        Movie IDs chosen by every user.
+    top_ns : list (int)
+        Number of recommendations of every user.
 
+    Returns
+    -------
+    list (numpy.ndarray or None)
+        Recommended movie IDs of every user, best first, or None where
+        `collab_from_neighbours` would give None.
 
+    """
+    results = [None] * len(seed_lists)
+    index = current_index(load_collab_neighbours)
+    if index is None:
+        return results
+    rows, item_ids, indices, scores, _ = index
+    idx = [[rows[movie_id] for movie_id in movie_ids if movie_id in rows]
+           for movie_ids in seed_lists]
+    exact = [indices.shape[1] - len(rows) + 1 for rows in idx]
+    answerable = [i for i, rows in enumerate(idx) if rows and top_ns[i] <= exact[i]]
+    if not answerable:
+        return results
+    top_indexes, _ = merge_neighbour_batch(indices, scores, [idx[i] for i in answerable],
+                                           n=max(exact[i] for i in answerable))
+    top_ids = item_ids[np.maximum(top_indexes, 0)]
+    # Keeping exact neighbours which have a title
+    keep = ((top_indexes >= 0)
+            & (np.arange(top_indexes.shape[1]) < np.array([exact[i] for i in answerable])[:, None])
+            & (load_catalogue().rows(top_ids.ravel()).reshape(top_ids.shape) >= 0))
+    for i, ids, found in zip(answerable, top_ids, keep):
+        ids = ids[found]
+        if len(ids) >= top_ns[i]:
+            results[i] = ids[:top_ns[i]]
+    return results
+
+# Approximate nearest neighbour index over the SVD item factors,
+# see resources/models/build_colbased_index.py
+ANN_PATH = 'resources/models/svd_ann.npz'
+ANN_NEIGHBOURS = 100
+# Smallest catalogue searched with the ANN index. Below it, scanning every
+# movie (`collab_from_scan`) is exact and no slower.
+ANN_MIN_ITEMS = 100_000
+# Lowest recall@10, measured when the index was built, of an index served
+ANN_MIN_RECALL = 0.5
+
+@resource('collab_ann')
+def load_collab_ann():
+    """Load the approximate nearest neighbour index of the item factors.
 
-def prediction_item(item_id):
-    """Map a given favourite movie to users within the
-       MovieLens dataset with the same preference.
+    Returns
+    -------
+    tuple (dict, IVFIndex, str) or None
+        Row of every movie ID, the index and the fingerprint of the model
+        it was built from, or None if it has not been built.
+
+    """
+    if not os.path.exists(ANN_PATH):
+        return None
+    index = IVFIndex.load(ANN_PATH)
+    rows = {movie_id: row for row, movie_id in enumerate(index.item_ids.tolist())}
+    return rows, index, index.source
+
+@timed('collab.ann')
+def collab_from_ann(movie_ids, top_n):
+    """Rank movies by merging the approximate nearest neighbours (by item
+       factors) of the chosen movies.
+
+    Serves the requests the exact neighbour table cannot answer: more
+    recommendations than its exact bound, or chosen movies missing from
+    the table. Each chosen movie is searched for enough neighbours to
+    cover `top_n`, scanning the number of partitions tuned for recall
+    when the index was built. The index is not used for catalogues below
+    `ANN_MIN_ITEMS` movies, or when its recall is below `ANN_MIN_RECALL`
+    (or was never measured).
 
     Parameters
     ----------
-    item_id : int
-        A MovieLens Movie ID.
+    movie_ids : list (int)
+        Movie IDs of the chosen movies.
+    top_n : int
+        Number of movies to return.
 
     Returns
     -------
-    list
-        User IDs of users with similar high ratings for the given movie.
+    numpy.ndarray or None
+        Movie IDs of the most similar movies, best first, or None when the
+        index is missing, stale or not used (see above), knows none of the
+        chosen movies or returned too few neighbours.
+
+    """
+    if len(get_factors().item_ids) < ANN_MIN_ITEMS:
+        return None
+    ann = current_index(load_collab_ann)
+    if ann is None:
+        return None
+    rows, index, _ = ann
+    if index.recall is None or index.recall < ANN_MIN_RECALL:
+        return None
+    idx = [rows[movie_id] for movie_id in movie_ids if movie_id in rows]
+    if not idx:
+        return None
+    indices, scores = index.search(index.vector(idx), max(ANN_NEIGHBOURS, top_n + len(idx)))
+    found = indices >= 0
+    top_indexes, _ = merge_neighbours(indices[found], scores[found], exclude=idx,
+                                      n=indices.size)
+    # Keeping movies which have a title
+    top_ids = index.item_ids[top_indexes]
+    top_ids = top_ids[load_catalogue().rows(top_ids) >= 0]
+    if len(top_ids) < top_n:
+        return None
+    return top_ids[:top_n]
+
+def collab_batch(seed_lists, top_n=10, chunk_size=256, aggregate='mean'):
+    """Recommend movies for many lists of chosen movies at once.
+
+    Movies are compared by the cosine similarity of their SVD item
+    factors, as in the precomputed neighbours. Every chunk of lists is
+    scored with one sparse-dense product (the mean unit vector of every
+    list) followed by one dense product against all item factors. By
+    default movies are ranked by their mean similarity to the chosen
+    movies, so results differ from `collab_model`, where a movie keeps
+    its best similarity to any chosen movie. `aggregate='max'` ranks as
+    the neighbour merge of `collab_model` does, scoring every chosen
+    movie on its own row.
+
+    Parameters
+    ----------
+    seed_lists : iterable (list (int))
+        Movie IDs chosen by every user, of any length. Movies unknown to
+        the model are ignored.
+    top_n : int
+        Number of recommendations per user.
+    chunk_size : int
+        Number of users scored at once.
+    aggregate : str
+        'mean' or 'max' similarity to the chosen movies, see above.
+
+    Yields
+    ------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Recommended movie IDs and their similarity, best first, for
+        every user of the next chunk. Missing recommendations are padded
+        with -1 and -inf.
 
     """
-    # Data preprosessing
-    reader = Reader(rating_scale=(0.5, 5))
-    load_df = Dataset.load_from_df(ratings_df,reader)
-    a_train = load_df.build_full_trainset()
+    factors = get_factors()
+    units = factors.item_units()
+    # Movies missing from the movie titles are never recommended
+    invalid = load_catalogue().rows(factors.item_ids) < 0
+
+    def item_rows(movie_ids):
+        rows = factors.item_rows(movie_ids)
+        return rows[rows >= 0]
+
+    def score(seeds):
+        return (seeds @ units) @ units.T
 
-    predictions = []
-    for ui in a_train.all_users():
-        predictions.append(model.predict(iid=item_id,uid=ui, verbose = False))
-    return predictions
+    for top, scores in stream_top_k((item_rows(movie_ids) for movie_ids in seed_lists),
+                                    len(units), score, top_n, invalid, chunk_size, aggregate):
+        yield np.where(top >= 0, factors.item_ids[top], -1), scores
 
-def pred_movies(movie_list):
-    """Maps the given favourite movies selected within the app to corresponding
-    users within the MovieLens dataset.
+@timed('collab.scan')
+def collab_from_scan(movie_ids, top_n):
+    """Rank movies by their exact best similarity to the chosen movies,
+       scoring every movie against their item factors.
+
+    Gives the answer the neighbour table would with unlimited neighbours,
+    for requests which no up-to-date index can answer.
 
     Parameters
     ----------
-    movie_list : list
-        Three favourite movies selected by the app user.
+    movie_ids : list (int)
+        Movie IDs of the chosen movies.
+    top_n : int
+        Number of movies to return.
 
     Returns
     -------
-    list
-        User-ID's of users with similar high ratings for each movie.
+    numpy.ndarray or None
+        Movie IDs of the most similar movies, best first, or None when the
+        model knows none of the chosen movies.
 
     """
-    # Store the id of users
-    id_store=[]
-    # For each movie selected by a user of the app,
-    # predict a corresponding user within the dataset with the highest rating
-    for i in movie_list:
-        predictions = prediction_item(item_id = i)
-        predictions.sort(key=lambda x: x.est, reverse=True)
-        # Take the top 10 user id's from each movie with highest rankings
-        for pred in predictions[:10]:
-            id_store.append(pred.uid)
-    # Return a list of user id's
-    return id_store
+    top_ids, _ = next(collab_batch([movie_ids], top_n, aggregate='max'))
+    top_ids = top_ids[0][top_ids[0] >= 0]
+    return top_ids if len(top_ids) else None
+
+def collab_version():
+    """Version of the model and indexes, used to key cached results."""
+    return model_version([MODEL_PATH, os.path.join(FACTORS_DIR, 'manifest.json'),
+                          NEIGHBOUR_MANIFEST_PATH, ANN_PATH, WARMUP_PATH])
 
 # !! DO NOT CHANGE THIS FUNCTION SIGNATURE !!
 # You are, however, encouraged to change its content.  
 
+@cached_recommendations('collaborative', version=collab_version)
+@timed('collab.model')
 def collab_model(movie_list,top_n=10):
-    """Short summary.
-    arameters
+    """Performs Collaborative filtering based upon a list of movies supplied
+       by the app user.
+
+    Parameters
     ----------
-    movie_list : type
-        Description of parameter `movie_list`.
-    top_n : type
-        Description of parameter `top_n`.
+    movie_list : list (str)
+        Favorite movies chosen by the app user.
+    top_n : int
+        Number of top recommendations to return to the user.
+
     Returns
     -------
-    type
-        Description of returned object.
-    """
-    #getting list of ids of 10 users that rated movies highly
-    user_ids = pred_movies(movie_list)
+    list (str)
+        Titles of the top-n movie recommendations to the user.
 
-    #obtaining the ratings of the users
+    Notes
+    -----
+    Movies are ranked by their best item-factor cosine similarity to a
+    chosen movie, taken from the first source able to answer:
 
-    df_init_users = ratings_df[ratings_df['userId'].isin(user_ids)]
+    1. the warm-up lookups, exact within their bound;
+    2. the neighbour table, exact within its bound;
+    3. the ANN index, approximate, for requests beyond the bound of the
+       table or movies missing from it, in large catalogues only;
+    4. a scan of every movie, exact, when no up-to-date index answers.
 
-    # for i in user_ids:
-    #     df_init_users = df_init_users.append(ratings_df[ratings_df['userId']==i])
+    When the model knows none of the chosen movies, there is nothing to
+    be similar to, and movies are ranked by the predicted rating of a new
+    user instead (`collab_from_factors`, whose docstring explains why it
+    is not used otherwise).
 
-    df_init_users=df_init_users.drop_duplicates().reset_index(drop=True)
-    
+    """
     #obtaining movieIds from movie titles
-    movie_ids = []
-    for movie in movie_list:
-        movie_ids.append(int(movies_df['movieId'][movies_df['title']==movie]))
-    
-    #adding new user
-    new_row1 = {'userId':1234567, 'movieId':movie_ids[0], 'rating':5}
-    new_row2 = {'userId':1234567, 'movieId':movie_ids[1], 'rating':5}
-    new_row3 = {'userId':1234567, 'movieId':movie_ids[2], 'rating': 5}
-    df_init_users = df_init_users.append([new_row1,new_row2,new_row3],ignore_index=True)
-
-    #pivot ratings
-    pivot_user = pd.pivot_table(df_init_users,values='rating',columns='userId',index='movieId')
-    pivot_user.fillna(0, inplace=True)
-    
-    pivot_user = pivot_user.apply(lambda x: (x-np.min(x))/(np.max(x)-np.min(x)), axis=1)
-
-    pivot_user_arr =  np.array(pivot_user)
-    
-    #finding movies similarities based on users
-    cosine_sim=cosine_similarity(pivot_user_arr,pivot_user_arr)
-    
-    #mat
-    m_index_list = list(pivot_user.index)
-    df = movies_df[movies_df['movieId'].isin(m_index_list)].reset_index(drop=True)
-
-    #Obtaining indices
-    indices = pd.Series(df['title'])
-    idx_1 = indices[indices == movie_list[0]].index[0]
-    idx_2 = indices[indices == movie_list[1]].index[0]
-    idx_3 = indices[indices == movie_list[2]].index[0]
-
-    rank_1 = cosine_sim[idx_1]
-    rank_2 = cosine_sim[idx_2]
-    rank_3 = cosine_sim[idx_3]
-
-    score_series_1 = pd.Series(rank_1).sort_values(ascending = False)
-    score_series_2 = pd.Series(rank_2).sort_values(ascending = False)
-    score_series_3 = pd.Series(rank_3).sort_values(ascending = False)
-
-    # Appending the names of movies
-    listings = score_series_1.append(score_series_1).append(score_series_3).sort_values(ascending = False)
-    recommended_movies = []
-    # Choose top 50
-    top_50_indexes = list(listings.iloc[1:50].index)
-    # Removing chosen movies
-    top_indexes = np.setdiff1d(top_50_indexes,[idx_1,idx_2,idx_3])
-    for i in top_indexes[:10]:
-        recommended_movies.append(list(movies_df['title'])[i])
-        
+    catalogue = load_catalogue()
+    movie_ids = catalogue.ids_for_titles(movie_list).tolist()
+
+    top_ids = warm_recommendations('collab', movie_ids, top_n, get_factors().fingerprint)
+    if top_ids is None:
+        top_ids = collab_from_neighbours(movie_ids, top_n)
+    if top_ids is None:
+        top_ids = collab_from_ann(movie_ids, top_n)
+    if top_ids is None:
+        top_ids = collab_from_scan(movie_ids, top_n)
+    if top_ids is None:
+        top_ids = collab_from_factors(movie_ids, top_n)
+    recommended_movies = catalogue.titles_for_ids(top_ids)
     return recommended_movies
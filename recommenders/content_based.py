@@ -29,21 +29,117 @@
 
 # Script dependencies
 import os
+import json
+import functools
 import pandas as pd
 import numpy as np
-import re
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
+from utils.data_loader import hash_files, save_frame, load_frame, load_movies, load_catalogue, MOVIES_PATH
+from utils.registry import resource
+from utils.instrumentation import span, timed
+from utils.result_cache import cached_recommendations, model_version
+from recommenders.warmup import warm_recommendations, WARMUP_PATH
+from utils.ranking import top_k, neighbour_table, merge_neighbours, merge_neighbour_batch, stream_top_k
+
+# Source data of the content corpus
+IMDB_PATH = 'resources/data/imdb_data.csv'
+TAGS_PATH = 'resources/data/tags.csv'
+
+# Cleaned corpus cache, keyed by a hash of the source data.
+# Bump the version whenever the cleaning steps change.
+CORPUS_VERSION = 2
+CORPUS_DIR = 'resources/models'
+
+# Persisted content-based similarity index, see `build_content_index`
+SUBSET_SIZE = 27000
+TFIDF_PATH = 'resources/models/content_tfidf.npz'
+TITLES_PATH = 'resources/models/content_titles.csv'
+NEIGHBOURS_PATH = 'resources/models/content_neighbours.npz'
+NEIGHBOURS_K = 100
+MANIFEST_PATH = 'resources/models/content_index.json'
+
+# Resources loaded in the background when the app starts
+PRELOAD = ['warmup', 'content_neighbours']
+
+@timed('content.build_corpus')
+def build_corpus():
+    """Merge and clean the movie metadata into text documents.
 
-# Importing data
-movies = pd.read_csv('resources/data/movies.csv')
-ratings = pd.read_csv('resources/data/ratings.csv')
-imdb = pd.read_csv('resources/data/imdb_data.csv')
-tags = pd.read_csv('resources/data/tags.csv')
+    Returns
+    -------
+    Pandas Dataframe
+        movieId, title and cleaned `documents` of every movie.
+
+    """
+    movies = load_movies(MOVIES_PATH)
+    imdb = pd.read_csv(IMDB_PATH)
+    tags = pd.read_csv(TAGS_PATH)
+
+    #grouping the lower cased tags based on movieId
+    tag = tags['tag'].map(str).str.lower()
+    grouped_tags = tag.groupby(tags['movieId']).agg(' '.join).rename('tag').reset_index()
+
+    movies_imdb = pd.merge(movies,imdb, on='movieId',how='left')
+    movies_imdb_tags = pd.merge(movies_imdb,grouped_tags, on='movieId',how='left')
+    # One document per movie, so that corpus rows match the catalogue rows
+    movies_imdb_tags = movies_imdb_tags.drop_duplicates('movieId').reset_index(drop=True)
+
+    #genres: replace separators with space and lowercase
+    genres = movies_imdb_tags['genres'].map(str).str.replace('|', ' ', regex=False).str.lower()
+
+    #five lead actors/actresses, joined without spaces and lowercased
+    lead_actors = (movies_imdb_tags['title_cast'].map(str).str.split('|')
+                   .str[:5].str.join('')
+                   .str.replace(r'\s+', '', regex=True).str.lower())
+
+    #directors: removing spaces, dots and dashes and lowercasing
+    director = (movies_imdb_tags['director'].map(str)
+                .str.replace(r'\s+|\.|\-', '', regex=True).str.lower())
 
+    #plot_keywords: replacing separator with spaces
+    plot_keywords = movies_imdb_tags['plot_keywords'].map(str).str.replace('|', ' ', regex=False)
 
+    #year taken from the title
+    year = (movies_imdb_tags['title'].str.findall(r'\(+\d+\)').str.join('')
+            .str.replace(r'\(|\)', '', regex=True))
 
-movies.dropna(inplace=True)
+    documents = genres+" "+lead_actors+" "+director+" "+plot_keywords+" "+movies_imdb_tags['tag']+" "+year
+
+    corpus = movies_imdb_tags[['movieId', 'title']].copy()
+    corpus['documents'] = documents.map(str)
+    return corpus
+
+@functools.lru_cache(maxsize=None)
+def corpus_key():
+    """Identify the current version of the content corpus.
+
+    Returns
+    -------
+    str
+        Hash of the source CSVs and the corpus version.
+
+    """
+    digest = hash_files([MOVIES_PATH, IMDB_PATH, TAGS_PATH])
+    return f'v{CORPUS_VERSION}_{digest[:16]}'
+
+@resource('content_corpus')
+def load_corpus():
+    """Load the cleaned content corpus, rebuilding it only when the
+       source data has changed.
+
+    Returns
+    -------
+    Pandas Dataframe
+        movieId, title and cleaned `documents` of every movie.
+
+    """
+    path = os.path.join(CORPUS_DIR, f'content_corpus_{corpus_key()}')
+    corpus = load_frame(path)
+    if corpus is None:
+        corpus = build_corpus()
+        save_frame(corpus, path)
+    return corpus
 
 def data_preprocessing(subset_size):
     """Prepare data for use within Content filtering algorithm.
@@ -59,87 +155,247 @@ def data_preprocessing(subset_size):
         Subset of movies selected for content-based filtering.
 
     """
+    # Subset of the data
+    movies_subset = load_corpus()[:subset_size]
+    return movies_subset
 
-    #convert all the tags to strings and lower case them
-    tags['tag'] = tags['tag'].map(str).str.lower()
-    
-    #grouping tags based on movieId
-    grouped_tags = tags.groupby('movieId')['tag'].apply(' '.join).reset_index()
+@timed('content.build_index')
+def build_content_index(subset_size=SUBSET_SIZE, tfidf_path=TFIDF_PATH,
+                        titles_path=TITLES_PATH):
+    """Fit the TF-IDF model once and persist it for the query path.
 
-    movies_imdb = pd.merge(movies,imdb, on='movieId',how='left')
+    The L2-normalised TF-IDF matrix is stored in sparse form, so the
+    cosine similarity between two movies is the dot product of their rows.
+
+    Parameters
+    ----------
+    subset_size : int
+        Number of movies to index.
+    tfidf_path : str
+        Destination of the sparse TF-IDF matrix (.npz).
+    titles_path : str
+        Destination of the row -> title mapping (.csv).
+
+    Returns
+    -------
+    tuple (scipy.sparse.csr_matrix, Pandas Series)
+        TF-IDF matrix and the title of each of its rows.
 
-    movies_imdb_tags = pd.merge(movies_imdb,grouped_tags, on='movieId',how='left')
-    
-    
-    """This part of the function is for cleaning genres column
     """
-    #replace separators with space
-    pattern = r'\|'
-    movies_imdb_tags['genres'] = movies_imdb_tags['genres'].apply(lambda x: re.sub(pattern, ' ', str(x)))
-    
-    #lowercase
-    movies_imdb_tags['genres'] = movies_imdb_tags['genres'].str.lower()
-    
-    
-    """This cleans and retrieves and the lead actor/actress from the title_cast 
+    data = data_preprocessing(subset_size)
+    # Instantiating and generating the count matrix
+    count_vec = TfidfVectorizer(stop_words=['nan','Nan','NAN','NaN','np.nan'],
+                                analyzer='word', norm='l2', dtype=np.float32)
+    count_matrix = count_vec.fit_transform(data['documents'].apply(lambda x: np.str_(x)))
+    count_matrix = count_matrix.tocsr()
+    titles = data['title'].reset_index(drop=True)
+    sparse.save_npz(tfidf_path, count_matrix, compressed=False)
+    titles.to_frame().to_csv(titles_path, index=False)
+    # The neighbour table of a previous index is no longer valid
+    if os.path.exists(NEIGHBOURS_PATH):
+        os.remove(NEIGHBOURS_PATH)
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump({'corpus': corpus_key(), 'subset_size': subset_size}, f)
+    return count_matrix, titles
+
+def content_fingerprint():
+    """Identify the content index and neighbour table served by the app."""
+    return f'{corpus_key()}_{SUBSET_SIZE}_{NEIGHBOURS_K}'
+
+def content_index_current():
+    """Check whether the persisted index matches the current corpus.
+
+    Returns
+    -------
+    bool
+        True if the index was built from the current corpus.
+
     """
-    #converting to string
-    movies_imdb_tags['title_cast'] = movies_imdb_tags['title_cast'].apply(lambda x : str(x))
-    
-    #creating list of cast members based on separator
-    movies_imdb_tags['title_cast'] = movies_imdb_tags['title_cast'].str.split('|')
-    
-    #taking first item of list
-    movies_imdb_tags['title_cast'] =  movies_imdb_tags['title_cast'].apply(lambda x: x[0:5])
-
-    movies_imdb_tags['title_cast'] =  movies_imdb_tags['title_cast'].apply(lambda x: " ".join(x))
-    #removing space
-    pattern = r'\s{1,}'
-    movies_imdb_tags['title_cast'] = movies_imdb_tags['title_cast'].apply(lambda x: re.sub(pattern, '', str(x)))
-    
-    #lowercasing
-    movies_imdb_tags['title_cast'] = movies_imdb_tags['title_cast'].str.lower()
-
-    #renaming column
-    movies_imdb_tags.rename(columns ={'title_cast':'5lead_actors'},inplace = True)
-    
-    """This part of the function cleans the directors column
+    if not all(os.path.exists(path) for path in [TFIDF_PATH, TITLES_PATH, MANIFEST_PATH]):
+        return False
+    with open(MANIFEST_PATH) as f:
+        manifest = json.load(f)
+    return manifest == {'corpus': corpus_key(), 'subset_size': SUBSET_SIZE}
+
+@resource('content_index')
+def load_content_index():
+    """Load the persisted TF-IDF index, (re)building it when it is
+       missing or out of date.
+
+    Returns
+    -------
+    tuple (scipy.sparse.csr_matrix, Pandas Series)
+        TF-IDF matrix and the title of each of its rows.
+
     """
-    #removing spaces
-    pattern = r'\s{1,}'
-    movies_imdb_tags['director'] = movies_imdb_tags['director'].apply(lambda x: re.sub(pattern, '', str(x)))
-    
-    # removing commas and dashes
-    pattern = r'\.|\-'
-    movies_imdb_tags['director'] = movies_imdb_tags['director'].apply(lambda x: re.sub(pattern, '', str(x)))
-
-    #lowercasing
-    movies_imdb_tags['director'] = movies_imdb_tags['director'].str.lower()
-    
-    """This part of the function cleans the plot_keywords
+    if not content_index_current():
+        return build_content_index()
+    count_matrix = sparse.load_npz(TFIDF_PATH).tocsr()
+    titles = pd.read_csv(TITLES_PATH, keep_default_na=False)['title']
+    return count_matrix, titles
+
+@timed('content.build_neighbours')
+def build_content_neighbours(count_matrix, k=NEIGHBOURS_K,
+                             neighbours_path=NEIGHBOURS_PATH):
+    """Precompute and persist the top-k most similar movies of every movie.
+
+    Parameters
+    ----------
+    count_matrix : scipy.sparse.csr_matrix
+        L2-normalised TF-IDF matrix.
+    k : int
+        Number of neighbours to store per movie.
+    neighbours_path : str
+        Destination of the neighbour table (.npz).
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Neighbour rows and cosine similarities, best first.
+
     """
-    #replacing separator with spaces
-    pattern = r'\|'
-    movies_imdb_tags['plot_keywords'] = movies_imdb_tags['plot_keywords'].apply(lambda x: re.sub(pattern, ' ', str(x)))
+    indices, scores = neighbour_table(count_matrix, k)
+    np.savez(neighbours_path, indices=indices, scores=scores)
+    return indices, scores
 
-    #creating year column
-    pattern = r'\(+\d+\)'
-    movies_imdb_tags['year'] = movies_imdb_tags['title'].apply(lambda x: ''.join(re.findall(pattern, x)))
+@resource('content_neighbours')
+def load_content_neighbours():
+    """Load the persisted neighbour table, (re)building it when it is
+       missing or out of date.
 
-    pattern = r'\(|\)'
-    movies_imdb_tags['year'] = movies_imdb_tags['year'].apply(lambda x: re.sub(pattern,'',x))
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Neighbour rows and cosine similarities, best first.
 
+    """
+    if not (content_index_current() and os.path.exists(NEIGHBOURS_PATH)):
+        return build_content_neighbours(load_content_index()[0])
+    with np.load(NEIGHBOURS_PATH) as table:
+        return table['indices'], table['scores']
 
-    movies_imdb_tags['documents'] = movies_imdb_tags['genres']+" "+movies_imdb_tags['5lead_actors']+" "+movies_imdb_tags['director']+" "+movies_imdb_tags['plot_keywords']+" "+movies_imdb_tags['tag']+" "+movies_imdb_tags['year']
+@timed('content.rank_corpus')
+def rank_from_index(idx, top_n):
+    """Rank the whole corpus against the given rows of the TF-IDF index.
 
-    movies_imdb_tags['documents'] =  movies_imdb_tags['documents'].map(str)
+    Used when more recommendations are requested than the neighbour
+    table holds.
 
-    # Subset of the data
-    movies_subset = movies_imdb_tags[:subset_size]
-    return movies_subset
+    Parameters
+    ----------
+    idx : list (int)
+        Index rows of the chosen movies.
+    top_n : int
+        Number of rows to return.
+
+    Returns
+    -------
+    numpy.ndarray
+        Index rows of the most similar movies, best first.
+
+    """
+    count_matrix, _ = load_content_index()
+    # Similarity of the chosen movies against the whole corpus only
+    rank = (count_matrix @ count_matrix[idx].T).toarray()
+    # Each movie keeps its best score across the chosen movies
+    scores = rank.max(axis=1)
+    # Removing chosen movies
+    scores[idx] = -np.inf
+    return top_k(scores, top_n)
+
+@timed('content.merge_batch')
+def content_neighbour_batch(seed_lists, top_ns):
+    """Answer many requests at once from the precomputed neighbours.
+
+    The neighbour rows of the chosen movies of every request are gathered
+    and merged together, ranking as `content_model` does. Requests the
+    table cannot answer exactly are left for `content_batch`.
+
+    Parameters
+    ----------
+    seed_lists : list (list (int))
+        Movie IDs chosen by every user.
+    top_ns : list (int)
+        Number of recommendations of every user.
+
+    Returns
+    -------
+    list (numpy.ndarray or None)
+        Recommended movie IDs of every user, best first, or None when a
+        chosen movie is not indexed or too many movies are requested.
+
+    """
+    catalogue = load_catalogue(MOVIES_PATH)
+    neighbours, scores = load_content_neighbours()
+    idx = [catalogue.rows(movie_ids) for movie_ids in seed_lists]
+    # Only the first k - len(idx) + 1 merged neighbours are exact
+    answerable = [i for i, rows in enumerate(idx)
+                  if len(rows) and ((rows >= 0) & (rows < len(neighbours))).all()
+                  and top_ns[i] <= neighbours.shape[1] - len(rows) + 1]
+    results = [None] * len(seed_lists)
+    if not answerable:
+        return results
+    top_indexes, _ = merge_neighbour_batch(neighbours, scores, [idx[i] for i in answerable],
+                                           n=max(top_ns[i] for i in answerable))
+    for i, rows in zip(answerable, top_indexes):
+        rows = rows[:top_ns[i]]
+        results[i] = catalogue.movie_ids[rows[rows >= 0]]
+    return results
+
+def content_batch(seed_lists, top_n=10, chunk_size=256, aggregate='mean'):
+    """Recommend movies for many lists of chosen movies at once.
+
+    Every chunk of lists is scored against the whole corpus with a single
+    product of sparse matrices. By default movies are ranked by their mean
+    similarity to the chosen movies, which is what a matrix product
+    computes, so results differ from `content_model`, where a movie keeps
+    its best similarity to any chosen movie. `aggregate='max'` ranks as
+    `content_model` does, scoring every chosen movie on its own row.
+
+    Parameters
+    ----------
+    seed_lists : iterable (list (int))
+        Movie IDs chosen by every user, of any length. Movies outside the
+        index are ignored.
+    top_n : int
+        Number of recommendations per user.
+    chunk_size : int
+        Number of users scored at once.
+    aggregate : str
+        'mean' or 'max' similarity to the chosen movies, see above.
+
+    Yields
+    ------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Recommended movie IDs and their similarity, best first, for
+        every user of the next chunk. Missing recommendations are padded
+        with -1 and -inf.
+
+    """
+    catalogue = load_catalogue(MOVIES_PATH)
+    count_matrix, _ = load_content_index()
+    n_indexed = count_matrix.shape[0]
+
+    def index_rows(movie_ids):
+        rows = catalogue.rows(movie_ids)
+        return rows[(rows >= 0) & (rows < n_indexed)]
+
+    def score(seeds):
+        return ((seeds @ count_matrix) @ count_matrix.T).toarray()
+
+    for top, scores in stream_top_k((index_rows(movie_ids) for movie_ids in seed_lists),
+                                    n_indexed, score, top_n, chunk_size=chunk_size,
+                                    aggregate=aggregate):
+        yield np.where(top >= 0, catalogue.movie_ids[top], -1), scores
+
+def content_version():
+    """Version of the persisted index, used to key cached results."""
+    return model_version([MANIFEST_PATH, NEIGHBOURS_PATH, WARMUP_PATH])
 
 # !! DO NOT CHANGE THIS FUNCTION SIGNATURE !!
 # You are, however, encouraged to change its content.  
+@cached_recommendations('content', version=content_version)
+@timed('content.model')
 def content_model(movie_list,top_n=10):
     """Performs Content filtering based upon a list of movies supplied
        by the app user.
@@ -157,35 +413,29 @@ def content_model(movie_list,top_n=10):
         Titles of the top-n movie recommendations to the user.
 
     """
-    # Initializing the empty list of recommended movies
-    recommended_movies = []
-    data = data_preprocessing(27000) #27000
-    # Instantiating and generating the count matrix
-    count_vec =  TfidfVectorizer(stop_words=['nan','Nan','NAN','NaN','np.nan'],analyzer='word')
-    count_matrix = count_vec.fit_transform(data['documents'].apply(lambda x: np.str_(x)))
-    indices = pd.Series(data['title'])
-    cosine_sim = cosine_similarity(count_matrix, count_matrix)
-    # Getting the index of the movie that matches the title
-    idx_1 = indices[indices == movie_list[0]].index[0]
-    idx_2 = indices[indices == movie_list[1]].index[0]
-    idx_3 = indices[indices == movie_list[2]].index[0]
-    # Creating a Series with the similarity scores in descending order
-    rank_1 = cosine_sim[idx_1]
-    rank_2 = cosine_sim[idx_2]
-    rank_3 = cosine_sim[idx_3]
-    # Calculating the scores
-    score_series_1 = pd.Series(rank_1).sort_values(ascending = False)
-    score_series_2 = pd.Series(rank_2).sort_values(ascending = False)
-    score_series_3 = pd.Series(rank_3).sort_values(ascending = False)
-    # Getting the indexes of the 10 most similar movies
-    listings = score_series_1.append(score_series_1).append(score_series_3).sort_values(ascending = False)
-
+    catalogue = load_catalogue(MOVIES_PATH)
+    # Precomputed answer when all the movies are selectable in the app
+    top_ids = warm_recommendations('content', catalogue.ids_for_titles(movie_list).tolist(), top_n,
+                                   content_fingerprint())
+    if top_ids is not None:
+        return catalogue.titles_for_ids(top_ids)
+    # Getting the index rows of the chosen movies
+    idx = catalogue.rows_for_titles(movie_list).tolist()
+    # Merging the precomputed neighbours of the chosen movies
+    neighbours, scores = load_content_neighbours()
+    if max(idx) >= len(neighbours):
+        raise ValueError('Only the first {} movies are indexed'.format(len(neighbours)))
+    if top_n <= neighbours.shape[1] - len(idx) + 1:
+        with span('content.merge'):
+            top_indexes, _ = merge_neighbours(neighbours[idx], scores[idx],
+                                              exclude=idx, n=top_n)
+    else:
+        top_indexes = rank_from_index(idx, top_n)
     # Store movie names
-    recommended_movies = []
-    # Appending the names of movies
-    top_50_indexes = list(listings.iloc[1:50].index)
-    # Removing chosen movies
-    top_indexes = np.setdiff1d(top_50_indexes,[idx_1,idx_2,idx_3])
-    for i in top_indexes[:top_n]:
-        recommended_movies.append(list(movies['title'])[i])
+    recommended_movies = catalogue.titles[top_indexes].tolist()
     return recommended_movies
+
+if __name__ == '__main__':
+    count_matrix, _ = build_content_index()
+    build_content_neighbours(count_matrix)
+    print(f"Content index saved to: {TFIDF_PATH}, {TITLES_PATH} and {NEIGHBOURS_PATH}")
@@ -0,0 +1,321 @@
+"""
+
+    Vectorised scoring for matrix-factorisation models.
+
+    Author: Explore Data Science Academy.
+
+    Description: Provided within this file is a NumPy view of the
+    parameters learned by a biased matrix-factorisation model, such as
+    Surprise's `SVD`, which scores many ratings at once instead of calling
+    `model.predict` for every one, and can be saved as a bundle of
+    memory-mappable arrays instead of a pickle.
+
+"""
+
+# Script dependencies
+import os
+import json
+import hashlib
+import numpy as np
+from utils.data_loader import save_array, write_json, remove_versions
+from recommenders.ann_index import unit_rows
+
+# Arrays of a saved model, one `.npy` file each, see `FactorModel.save`
+BUNDLE_ARRAYS = ('pu', 'qi', 'bu', 'bi', 'user_ids', 'item_ids')
+BUNDLE_VERSION = 1
+
+class FactorModel:
+    """Learned parameters of a biased matrix-factorisation model.
+
+    The estimated rating of item i by user u follows Surprise's `SVD`:
+    ``global_mean + bu[u] + bi[i] + qi[i] . pu[u]``, where the bias of an
+    unknown user or item is zero and its factors are ignored.
+
+    Parameters
+    ----------
+    pu : numpy.ndarray
+        User factors, one row per known user.
+    qi : numpy.ndarray
+        Item factors, one row per known item.
+    bu : numpy.ndarray
+        User biases.
+    bi : numpy.ndarray
+        Item biases.
+    global_mean : float
+        Mean of all training ratings.
+    user_ids : array-like
+        Raw (MovieLens) user ID of every row of `pu`.
+    item_ids : array-like
+        Raw (MovieLens) movie ID of every row of `qi`.
+    rating_scale : tuple (float, float)
+        Lowest and highest possible ratings, used to clip estimates.
+    fingerprint : str, optional
+        Identifies the saved parameters, see `save`. Artifacts derived
+        from the model record it, so that they can be ignored once the
+        model has changed.
+
+    """
+
+    def __init__(self, pu, qi, bu, bi, global_mean, user_ids, item_ids,
+                 rating_scale=(0.5, 5), fingerprint=None):
+        self.pu = pu
+        self.qi = qi
+        self.bu = bu
+        self.bi = bi
+        self.global_mean = float(global_mean)
+        self.user_ids = np.asarray(user_ids)
+        self.item_ids = np.asarray(item_ids)
+        self.rating_scale = tuple(rating_scale)
+        self.fingerprint = fingerprint
+        self.user_index = {raw: inner for inner, raw in enumerate(self.user_ids.tolist())}
+        # Row of every movie ID, -1 for unknown IDs, as in `Catalogue`
+        self.item_id_rows = np.full(int(self.item_ids.max(initial=0)) + 1, -1, dtype=np.int64)
+        self.item_id_rows[self.item_ids] = np.arange(len(self.item_ids))
+        self._item_units = None
+
+    @classmethod
+    def from_surprise(cls, model, fingerprint=None):
+        """Extract the parameters of a fitted (biased) Surprise `SVD` model.
+
+        Parameters
+        ----------
+        model : surprise.SVD
+            Fitted model, including its trainset.
+        fingerprint : str, optional
+            Identifies the model, e.g. `pickle_fingerprint` of its file.
+
+        Returns
+        -------
+        FactorModel
+            NumPy view of the model parameters.
+
+        """
+        trainset = model.trainset
+        user_ids = [trainset.to_raw_uid(u) for u in range(trainset.n_users)]
+        item_ids = [trainset.to_raw_iid(i) for i in range(trainset.n_items)]
+        return cls(model.pu, model.qi, model.bu, model.bi,
+                   trainset.global_mean, user_ids, item_ids,
+                   trainset.rating_scale, fingerprint)
+
+    @staticmethod
+    def pickle_fingerprint(path):
+        """Fingerprint of a model unpickled from `path`."""
+        return f'pickle:{os.stat(path).st_mtime_ns}'
+
+    def save(self, directory):
+        """Save the parameters as a bundle of `.npy` files plus a manifest.
+
+        The arrays are written to new files named after a hash of their
+        contents, which is also the fingerprint of the model, and are
+        published by atomically replacing the manifest naming them. A
+        `load` thus reads either the previous bundle or the new one whole,
+        never a mix, and processes still memory-mapping an earlier bundle
+        keep reading it unchanged. The arrays of the bundle before the
+        previous one are removed.
+
+        Parameters
+        ----------
+        directory : str
+            Directory of the bundle, created if missing.
+
+        """
+        os.makedirs(directory, exist_ok=True)
+        values = {name: np.ascontiguousarray(getattr(self, name)) for name in BUNDLE_ARRAYS}
+        digest = hashlib.blake2b(digest_size=16)
+        for array in values.values():
+            digest.update(array.data)
+        fingerprint = digest.hexdigest()
+        arrays = {}
+        for name, array in values.items():
+            file = f'{name}.{fingerprint}.npy'
+            save_array(os.path.join(directory, file), array)
+            arrays[name] = dict(dtype=array.dtype.str, shape=list(array.shape), file=file)
+        manifest_path = os.path.join(directory, 'manifest.json')
+        previous = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                previous = json.load(f).get('arrays', {})
+        manifest = dict(version=BUNDLE_VERSION, global_mean=self.global_mean,
+                        rating_scale=list(self.rating_scale),
+                        n_factors=int(self.qi.shape[1]), arrays=arrays,
+                        fingerprint=fingerprint)
+        write_json(manifest_path, manifest)
+        # The previous bundle is kept for loads which read its manifest
+        # just before it was replaced
+        for name in BUNDLE_ARRAYS:
+            kept = previous[name].get('file', name + '.npy') if name in previous else None
+            remove_versions(directory, name, keep={arrays[name]['file'], kept})
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Load a bundle written by `save`.
+
+        The arrays are memory-mapped by default, so that processes serving
+        the same bundle share the factor matrices through the page cache.
+
+        Parameters
+        ----------
+        directory : str
+            Directory of the bundle.
+        mmap_mode : str or None
+            Passed on to `numpy.load`; None reads the arrays into memory.
+
+        Returns
+        -------
+        FactorModel
+            The saved model.
+
+        """
+        manifest_path = os.path.join(directory, 'manifest.json')
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != BUNDLE_VERSION:
+            raise ValueError(f"Unsupported model bundle version in {directory}")
+        arrays = {}
+        for name, spec in manifest['arrays'].items():
+            # Bundles saved before versioned files hold `<name>.npy`
+            array = np.load(os.path.join(directory, spec.get('file', name + '.npy')),
+                            mmap_mode=mmap_mode)
+            if array.dtype.str != spec['dtype'] or list(array.shape) != spec['shape']:
+                raise ValueError(f"{name}.npy does not match the manifest of {directory}")
+            arrays[name] = array
+        # Bundles saved before fingerprints are identified by their manifest
+        fingerprint = manifest.get('fingerprint', f'mtime:{os.stat(manifest_path).st_mtime_ns}')
+        return cls(arrays['pu'], arrays['qi'], arrays['bu'], arrays['bi'],
+                   manifest['global_mean'], arrays['user_ids'], arrays['item_ids'],
+                   manifest['rating_scale'], fingerprint)
+
+    @staticmethod
+    def exists(directory):
+        """Whether a complete bundle has been saved to `directory`."""
+        return os.path.exists(os.path.join(directory, 'manifest.json'))
+
+    def user_rows(self, user_ids):
+        """Map raw user IDs to rows of `pu`.
+
+        Parameters
+        ----------
+        user_ids : array-like
+            Raw user IDs.
+
+        Returns
+        -------
+        numpy.ndarray
+            Row of every user, or -1 for users unknown to the model.
+
+        """
+        return np.array([self.user_index.get(u, -1) for u in user_ids], dtype=np.int64)
+
+    def item_rows(self, item_ids):
+        """Map raw movie IDs to rows of `qi`.
+
+        Parameters
+        ----------
+        item_ids : array-like
+            Raw movie IDs.
+
+        Returns
+        -------
+        numpy.ndarray
+            Row of every movie, or -1 for movies unknown to the model.
+
+        """
+        item_ids = np.asarray(item_ids, dtype=np.int64)
+        known = (item_ids >= 0) & (item_ids < len(self.item_id_rows))
+        rows = np.full(item_ids.shape, -1, dtype=np.int64)
+        rows[known] = self.item_id_rows[item_ids[known]]
+        return rows
+
+    def item_units(self):
+        """Unit-length item factors, as float32, computed on first use.
+
+        Returns
+        -------
+        numpy.ndarray
+            Rows of `qi` scaled to unit length, for cosine similarities.
+
+        """
+        if self._item_units is None:
+            self._item_units = unit_rows(self.qi).astype(np.float32)
+        return self._item_units
+
+    def estimate(self, user_ids, item_ids):
+        """Estimate the ratings of many (user, item) pairs at once.
+
+        Parameters
+        ----------
+        user_ids : array-like
+            Raw user ID of every pair.
+        item_ids : array-like
+            Raw movie ID of every pair.
+
+        Returns
+        -------
+        numpy.ndarray
+            Estimated (clipped) rating of every pair.
+
+        """
+        users, items = self.user_rows(user_ids), self.item_rows(item_ids)
+        known_user, known_item = users >= 0, items >= 0
+        est = np.full(len(users), self.global_mean)
+        est[known_user] += self.bu[users[known_user]]
+        est[known_item] += self.bi[items[known_item]]
+        both = known_user & known_item
+        est[both] += np.einsum('ij,ij->i', self.pu[users[both]], self.qi[items[both]])
+        return np.clip(est, *self.rating_scale)
+
+    def fold_in_user(self, item_ids, ratings, reg=0.1):
+        """Fit the factors and bias of a user unknown to the model.
+
+        The item factors and biases are held fixed, and the user's
+        parameters solve the regularised least-squares problem of their
+        ratings, as in one user step of alternating least squares.
+
+        Parameters
+        ----------
+        item_ids : array-like
+            Raw movie IDs rated by the user. Movies unknown to the model
+            are ignored.
+        ratings : array-like
+            The user's rating of every movie.
+        reg : float
+            Regularisation of the factors and bias, per rating.
+
+        Returns
+        -------
+        tuple (numpy.ndarray, float)
+            Factors and bias of the user, zero when the model knows none
+            of the movies.
+
+        """
+        rows = self.item_rows(item_ids)
+        known = rows >= 0
+        rows = rows[known]
+        if not len(rows):
+            return np.zeros(self.qi.shape[1]), 0.0
+        z = np.column_stack([self.qi[rows], np.ones(len(rows))])
+        t = np.asarray(ratings, dtype=np.float64)[known] - self.global_mean - self.bi[rows]
+        gram = z.T @ z + reg * len(rows) * np.eye(z.shape[1])
+        x = np.linalg.solve(gram, z.T @ t)
+        return x[:-1], float(x[-1])
+
+    def score_items(self, pu, bu=0.0):
+        """Estimate the rating of every item by one user in a single pass.
+
+        Parameters
+        ----------
+        pu : numpy.ndarray
+            Factors of the user, e.g. from `fold_in_user`.
+        bu : float
+            Bias of the user.
+
+        Returns
+        -------
+        numpy.ndarray
+            Estimated rating of every row of `qi`. Estimates are not
+            clipped, so that they keep ranking items above the top of
+            the rating scale.
+
+        """
+        return self.global_mean + bu + self.bi + self.qi @ pu
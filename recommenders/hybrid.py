@@ -0,0 +1,239 @@
+"""
+
+    Hybrid filtering for item recommendation.
+
+    Author: Explore Data Science Academy.
+
+    Description: Blends the content-based and collaborative similarities
+    of movies. Rather than running both recommenders over the whole
+    catalogue, a shared candidate set is gathered once from the
+    precomputed neighbours of the chosen movies under both algorithms.
+    Every candidate is then scored against the chosen movies by its
+    TF-IDF cosine similarity, as stored with the content-based
+    neighbours, and by the cosine similarity of the SVD item factors, a
+    single product of small matrices. Both signals are rescaled to
+    [0, 1] over the candidates and blended with configurable weights.
+
+"""
+
+# Script dependencies
+import numpy as np
+from utils.data_loader import load_catalogue, MOVIES_PATH
+from utils.instrumentation import span, timed
+from utils.result_cache import cached_recommendations
+from utils.ranking import top_k
+from recommenders.warmup import warm_neighbours
+from recommenders import content_based, collaborative_based
+
+# Default weights of the content-based and collaborative similarities
+HYBRID_WEIGHTS = (0.5, 0.5)
+# Number of neighbours of every chosen movie added to the candidates,
+# per algorithm
+CANDIDATES_K = 100
+
+# Resources loaded in the background when the app starts
+PRELOAD = ['warmup', 'content_neighbours', 'svd_factors', 'collab_neighbours']
+
+def content_lists(movie_ids):
+    """Precomputed content-based neighbours of the chosen movies.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Neighbour movie IDs and similarities, best first, one row per
+        indexed chosen movie (padded with -1 and -inf).
+
+    """
+    found = warm_neighbours('content', movie_ids, content_based.content_fingerprint())
+    if found is not None:
+        return found
+    catalogue = load_catalogue(MOVIES_PATH)
+    neighbours, scores = content_based.load_content_neighbours()
+    rows = catalogue.rows(movie_ids)
+    rows = rows[(rows >= 0) & (rows < len(neighbours))]
+    return catalogue.movie_ids[neighbours[rows]], scores[rows]
+
+def collab_candidates(movie_ids, k):
+    """Movie IDs of the precomputed collaborative neighbours of the chosen
+       movies, or of the most similar movies to them by a full scan when
+       the neighbour index is missing or stale.
+    """
+    index = collaborative_based.current_index(collaborative_based.load_collab_neighbours)
+    if index is not None:
+        rows, item_ids, indices, _, _ = index
+        idx = [rows[movie_id] for movie_id in movie_ids if movie_id in rows]
+        if idx:
+            return item_ids[indices[idx, :k].ravel()]
+    top_ids = collaborative_based.collab_from_scan(movie_ids, k * len(movie_ids))
+    # No collaborative candidates when the model knows no chosen movie
+    return top_ids if top_ids is not None else np.empty(0, dtype=np.int64)
+
+@timed('hybrid.candidates')
+def hybrid_candidates(movie_ids, content, k=CANDIDATES_K):
+    """Gather the candidate movies of a request.
+
+    Parameters
+    ----------
+    movie_ids : list (int)
+        Movie IDs of the chosen movies.
+    content : tuple (numpy.ndarray, numpy.ndarray)
+        Content-based neighbours of the chosen movies, see `content_lists`.
+    k : int
+        Number of neighbours per chosen movie and algorithm.
+
+    Returns
+    -------
+    numpy.ndarray
+        Unique movie IDs of the content-based and collaborative
+        neighbours of the chosen movies, without the chosen movies and
+        movies missing from the movie titles.
+
+    """
+    # Precomputed neighbours of the movies selectable in the app
+    collab = warm_neighbours('collab', movie_ids, collaborative_based.get_factors().fingerprint)
+    collab = collab[0][:, :k].ravel() if collab is not None else collab_candidates(movie_ids, k)
+    candidates = np.concatenate([content[0][:, :k].ravel(), collab])
+    # Unique candidates, sorted, without the chosen movies
+    candidates = np.sort(candidates[candidates >= 0])
+    first = np.ones(len(candidates), dtype=bool)
+    first[1:] = candidates[1:] != candidates[:-1]
+    candidates = candidates[first & ~np.isin(candidates, movie_ids)]
+    return candidates[load_catalogue(MOVIES_PATH).rows(candidates) >= 0]
+
+def stored_scores(neighbours, scores, candidates):
+    """Best stored similarity of every candidate to a chosen movie.
+
+    Parameters
+    ----------
+    neighbours : numpy.ndarray
+        Neighbour movie IDs of the chosen movies, padded with -1.
+    scores : numpy.ndarray
+        Similarities matching `neighbours`.
+    candidates : numpy.ndarray
+        Movie IDs of the candidates.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Best similarity of every candidate, and whether it was found
+        among the neighbours at all.
+
+    """
+    neighbours, scores = np.ravel(neighbours), np.ravel(scores)
+    keep = neighbours >= 0
+    neighbours, scores = neighbours[keep], scores[keep]
+    if not len(neighbours):
+        return np.zeros(len(candidates)), np.zeros(len(candidates), dtype=bool)
+    # Best scoring entry of every neighbour, sorted by movie ID
+    order = np.lexsort((-scores, neighbours))
+    neighbours, scores = neighbours[order], scores[order]
+    first = np.ones(len(neighbours), dtype=bool)
+    first[1:] = neighbours[1:] != neighbours[:-1]
+    neighbours, scores = neighbours[first], scores[first]
+    position = np.searchsorted(neighbours, candidates).clip(max=len(neighbours) - 1)
+    found = neighbours[position] == candidates
+    return np.where(found, scores[position], 0.0), found
+
+def rescale(scores, known):
+    """Min-max scale the known scores to [0, 1]. Unknown scores are 0."""
+    scaled = np.zeros(len(scores))
+    if known.any():
+        low, high = scores[known].min(), scores[known].max()
+        scaled[known] = (scores[known] - low) / (high - low) if high > low else 1.0
+    return scaled
+
+@timed('hybrid.score')
+def hybrid_scores(movie_ids, candidates, content):
+    """Score candidate movies by their best similarity to any chosen movie.
+
+    Parameters
+    ----------
+    movie_ids : list (int)
+        Movie IDs of the chosen movies.
+    candidates : numpy.ndarray
+        Movie IDs of the candidates.
+    content : tuple (numpy.ndarray, numpy.ndarray)
+        Content-based neighbours of the chosen movies, see `content_lists`.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Content-based and collaborative similarity of every candidate,
+        scaled to [0, 1]. Candidates unknown to an algorithm score 0.
+
+    Notes
+    -----
+    Content-based similarities are read from the precomputed neighbours
+    of the chosen movies rather than recomputed from the TF-IDF index.
+    A candidate outside every stored list is less similar than all the
+    stored neighbours, and scores as the least similar of them.
+
+    """
+    catalogue = load_catalogue(MOVIES_PATH)
+    neighbours, scores = content
+    content, found = stored_scores(neighbours, scores, candidates)
+    n_indexed = len(content_based.load_content_neighbours()[0])
+    indexed = (catalogue.rows(candidates) < n_indexed) & (len(neighbours) > 0)
+    if (indexed & ~found).any():
+        content[indexed & ~found] = scores[np.isfinite(scores)].min()
+
+    factors = collaborative_based.get_factors()
+    units = factors.item_units()
+    seed_items = factors.item_rows(movie_ids)
+    seed_items = seed_items[seed_items >= 0]
+    items = factors.item_rows(candidates)
+    known = (items >= 0) & (len(seed_items) > 0)
+    collab = np.zeros(len(candidates))
+    if known.any():
+        collab[known] = (units[items[known]] @ units[seed_items].T).max(axis=1)
+    return rescale(content, indexed), rescale(collab, known)
+
+def hybrid_version():
+    """Version of the models of both algorithms, used to key cached results."""
+    return content_based.content_version() + '|' + collaborative_based.collab_version()
+
+@cached_recommendations('hybrid', version=hybrid_version)
+@timed('hybrid.model')
+def hybrid_model(movie_list, top_n=10, weights=HYBRID_WEIGHTS):
+    """Performs hybrid filtering based upon a list of movies supplied
+       by the app user.
+
+    Parameters
+    ----------
+    movie_list : list (str)
+        Favorite movies chosen by the app user.
+    top_n : int
+        Number of top recommendations to return to the user.
+    weights : tuple (float, float)
+        Weights of the content-based and collaborative similarities.
+
+    Returns
+    -------
+    list (str)
+        Titles of the top-n movie recommendations to the user. Fewer
+        titles are returned when the chosen movies have fewer candidates.
+
+    Raises
+    ------
+    ValueError
+        If a weight is negative or both weights are zero.
+
+    """
+    content_weight, collab_weight = weights
+    if min(weights) < 0 or content_weight + collab_weight <= 0:
+        raise ValueError('Weights must be non-negative and not both zero')
+    catalogue = load_catalogue(MOVIES_PATH)
+    movie_ids = catalogue.ids_for_titles(movie_list).tolist()
+    neighbours = content_lists(movie_ids)
+    candidates = hybrid_candidates(movie_ids, neighbours, max(CANDIDATES_K, top_n))
+    content, collab = hybrid_scores(movie_ids, candidates, neighbours)
+    # Candidates are ranked by one signal alone when the other is missing,
+    # e.g. when no chosen movie is known to the SVD model
+    if not collab.any() and content.any():
+        content_weight, collab_weight = 1.0, 0.0
+    elif not content.any() and collab.any():
+        content_weight, collab_weight = 0.0, 1.0
+    with span('hybrid.blend'):
+        scores = content_weight * content + collab_weight * collab
+        top_indexes = top_k(scores, top_n)
+    return catalogue.titles_for_ids(candidates[top_indexes])
@@ -0,0 +1,288 @@
+"""
+
+    Local recommendation service with request micro-batching.
+
+    Author: Explore Data Science Academy.
+
+    Description: A standalone asyncio server answering recommendation
+    queries over TCP on localhost, one JSON object per line:
+
+        {"algorithm": "content", "movies": ["Toy Story (1995)", ...], "top_n": 10}
+
+    is answered with `{"recommendations": [...]}` (or `{"error": ...}`),
+    echoing the `id` of the query if given. `top_n` is clamped to
+    [1, MAX_TOP_N]. Queries for the same
+    algorithm arriving within a few milliseconds of each other are
+    coalesced into one batch, scored in a worker thread while the server
+    keeps accepting queries, and the results are fanned back out to their
+    clients. A batch merges the precomputed neighbours of all its chosen
+    movies at once, as `content_model` and `collab_model` do for one
+    query, so answers match the app's own results. Only the queries the
+    neighbour tables cannot answer exactly are scored against the whole
+    catalogue, with one call of the batch API of the recommender.
+
+        python -m recommenders.server --port 8765
+
+    The Streamlit app becomes a client of the server when started with
+    `RECOMMENDER_SERVER=127.0.0.1:8765`, see `recommend`.
+
+"""
+# Script dependencies
+import json
+import socket
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utils.data_loader import load_catalogue
+from utils import instrumentation
+
+# Default address of the service
+HOST = '127.0.0.1'
+PORT = 8765
+# Longest wait for more queries once one is queued, and largest batch
+BATCH_WINDOW = 0.005
+MAX_BATCH = 256
+# Largest number of recommendations per query
+MAX_TOP_N = 500
+
+def content_scorer():
+    from recommenders.content_based import content_neighbour_batch, content_batch, content_model
+    return content_neighbour_batch, content_batch, content_model
+
+def collab_scorer():
+    from recommenders.collaborative_based import collab_neighbour_batch, collab_batch, collab_model
+    return collab_neighbour_batch, collab_batch, collab_model
+
+# Neighbour-table batch, full-catalogue batch API and single-query entry
+# point of every algorithm
+SCORERS = {'content': content_scorer, 'collab': collab_scorer}
+
+class MicroBatcher:
+    """Coalesce the queries of one algorithm into batches.
+
+    Parameters
+    ----------
+    algorithm : str
+        Key of `SCORERS`.
+    executor : concurrent.futures.Executor
+        Executor the batches are scored in.
+    window : float
+        Seconds to wait for more queries once one is queued.
+    max_batch : int
+        Largest number of queries per batch.
+
+    """
+
+    def __init__(self, algorithm, executor, window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        self.table_api, self.batch_api, self.single = SCORERS[algorithm]()
+        self.algorithm = algorithm
+        self.executor = executor
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.batches = 0
+        self.queries = 0
+
+    async def submit(self, movie_list, top_n):
+        """Queue a query and wait for its recommendations."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((movie_list, top_n, future))
+        return await future
+
+    async def run(self):
+        """Collect and score batches until cancelled."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batches += 1
+            self.queries += len(batch)
+            try:
+                results = await loop.run_in_executor(self.executor, self.score,
+                                                     [(movies, top_n) for movies, top_n, _ in batch])
+            except Exception as error:
+                results = [error] * len(batch)
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def score(self, queries):
+        """Recommend titles for a batch of (titles, top_n) queries.
+
+        Queries are answered from the neighbour tables where they hold an
+        exact answer, the others by the full-catalogue batch API. Queries
+        it cannot fully answer either (e.g. no chosen movie known to the
+        model), or every query of a batch one of these calls fails on, go
+        through the single-query entry point, with its fallbacks. Errors
+        are returned in place of the results of the queries they concern.
+        """
+        with instrumentation.request(f'{self.algorithm}_batch'):
+            catalogue = load_catalogue()
+            results = [None] * len(queries)
+            seed_lists, positions = {}, []
+            for position, (movie_list, top_n) in enumerate(queries):
+                try:
+                    seed_lists[position] = catalogue.ids_for_titles(movie_list).tolist()
+                    positions.append(position)
+                except KeyError as error:
+                    results[position] = KeyError(f'Unknown title: {error.args[0]}')
+            try:
+                found = self.table_api([seed_lists[p] for p in positions],
+                                       [queries[p][1] for p in positions])
+            except Exception:
+                # One bad query must not fail the others of its batch
+                instrumentation.count(f'server.{self.algorithm}.batch_errors')
+                found = [None] * len(positions)
+            for position, ids in zip(positions, found):
+                if ids is not None:
+                    results[position] = catalogue.titles_for_ids(ids)
+            positions = [p for p in positions if results[p] is None]
+            instrumentation.count(f'server.{self.algorithm}.scanned', len(positions))
+            if positions:
+                top_n = max(queries[p][1] for p in positions)
+                try:
+                    top_ids = np.vstack([ids for ids, _ in self.batch_api(
+                        [seed_lists[p] for p in positions], top_n, aggregate='max')])
+                except Exception:
+                    instrumentation.count(f'server.{self.algorithm}.batch_errors')
+                    top_ids = []
+                for position, ids in zip(positions, top_ids):
+                    ids = ids[:queries[position][1]]
+                    if (ids >= 0).all():
+                        results[position] = catalogue.titles_for_ids(ids)
+            for position, result in enumerate(results):
+                if result is None:
+                    try:
+                        results[position] = self.single(*queries[position])
+                    except Exception as error:
+                        results[position] = error
+            instrumentation.count(f'server.{self.algorithm}.queries', len(queries))
+            return results
+
+class RecommendationServer:
+    """Serve recommendation queries, see the module description."""
+
+    def __init__(self, window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        # One scoring thread: numpy already spreads a batch over the cores
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='scoring')
+        self.batchers = {algorithm: MicroBatcher(algorithm, self.executor, window, max_batch)
+                         for algorithm in SCORERS}
+
+    def stats(self):
+        return dict(batches={name: dict(batches=b.batches, queries=b.queries)
+                             for name, b in self.batchers.items()},
+                    metrics=instrumentation.snapshot())
+
+    async def answer(self, query):
+        if query.get('op') == 'stats':
+            return self.stats()
+        batcher = self.batchers.get(query.get('algorithm'))
+        if batcher is None:
+            raise ValueError(f"Unknown algorithm: {query.get('algorithm')}")
+        top_n = min(max(int(query.get('top_n', 10)), 1), MAX_TOP_N)
+        recommendations = await batcher.submit(list(query['movies']), top_n)
+        return dict(recommendations=recommendations)
+
+    async def reply(self, line, writer):
+        try:
+            query = json.loads(line)
+            response = await self.answer(query)
+        except Exception as error:
+            query, response = {}, dict(error=f'{type(error).__name__}: {error}')
+        if isinstance(query, dict) and 'id' in query:
+            response['id'] = query['id']
+        writer.write(json.dumps(response).encode() + b'\n')
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        # Queries of one connection are answered as they complete, so that
+        # pipelined queries can share a batch
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self.reply(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer.close()
+
+    def warm_up(self):
+        """Load the models and indexes of every algorithm before serving."""
+        movie_id = load_catalogue().movie_ids[:1].tolist()
+        for batcher in self.batchers.values():
+            batcher.table_api([movie_id], [1])
+            list(batcher.batch_api([movie_id], 1, aggregate='max'))
+
+    async def serve(self, host=HOST, port=PORT):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.warm_up)
+        runners = [asyncio.create_task(b.run()) for b in self.batchers.values()]
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving recommendations on {host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for runner in runners:
+                runner.cancel()
+
+def recommend(algorithm, movie_list, top_n=10, address=f'{HOST}:{PORT}', timeout=60):
+    """Ask a running server for recommendations (blocking client).
+
+    Parameters
+    ----------
+    algorithm : str
+        'content' or 'collab'.
+    movie_list : list (str)
+        Favorite movies chosen by the app user.
+    top_n : int
+        Number of top recommendations to return to the user.
+    address : str
+        'host:port' of the server.
+    timeout : float
+        Seconds to wait for the server.
+
+    Returns
+    -------
+    list (str)
+        Titles of the top-n movie recommendations to the user.
+
+    """
+    host, port = address.rsplit(':', 1)
+    with socket.create_connection((host, int(port)), timeout=timeout) as sock:
+        query = dict(algorithm=algorithm, movies=list(movie_list), top_n=top_n)
+        sock.sendall(json.dumps(query).encode() + b'\n')
+        response = json.loads(sock.makefile('rb').readline())
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return response['recommendations']
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve recommendations on localhost.")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--window-ms', type=float, default=BATCH_WINDOW * 1000)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    args = parser.parse_args(argv)
+    server = RecommendationServer(args.window_ms / 1000, args.max_batch)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+
+    Precomputed recommendations for the movies selectable in the app.
+
+    Author: Explore Data Science Academy.
+
+    Description: The app only lets users choose their favourite movies
+    from fixed slices of the movie titles. This script precomputes the
+    neighbour lists of every selectable movie under both algorithms, so
+    that any selected triple is answered by merging three short lists.
+
+    Run `python -m recommenders.warmup` from the root of the repository
+    to (re)build the lookup file.
+
+"""
+
+# Script dependencies
+import os
+import numpy as np
+from utils.data_loader import load_movie_titles, load_catalogue, MOVIES_PATH
+from utils.registry import resource
+from utils.instrumentation import timed
+from utils.ranking import top_k, merge_neighbours
+
+WARMUP_PATH = 'resources/models/warmup.npz'
+WARMUP_K = 100
+# Slices of the movie titles offered by the selectboxes in `edsa_recommender.main`
+SELECTABLE_SLICES = [(14930, 15200), (25055, 25255), (21100, 21200)]
+
+def selectable_ids():
+    """Movie IDs of every movie which can be selected in the app."""
+    title_list = load_movie_titles(MOVIES_PATH)
+    titles = [title for start, stop in SELECTABLE_SLICES for title in title_list[start:stop]]
+    return np.unique(load_catalogue(MOVIES_PATH).ids_for_titles(titles))
+
+def pad(rows, width, fill):
+    """Stack lists of unequal length into a fixed-width array."""
+    table = np.full((len(rows), width), fill)
+    for i, row in enumerate(rows):
+        table[i, :len(row)] = row
+    return table
+
+def build_warmup(path=WARMUP_PATH, k=WARMUP_K):
+    """Precompute the neighbours of every selectable movie.
+
+    Content neighbours come from the content-based neighbour table and
+    collaborative neighbours from the cosine similarity of the SVD item
+    factors, matching the precomputed paths of both recommenders. The
+    fingerprints of both sources are stored with them, see
+    `warm_neighbours`.
+
+    Parameters
+    ----------
+    path : str
+        Destination of the lookup file (.npz).
+    k : int
+        Number of neighbours stored per movie and algorithm.
+
+    """
+    # Imported here, as both recommenders read the lookup file
+    from recommenders import content_based, collaborative_based
+    from recommenders.ann_index import unit_rows
+    catalogue = load_catalogue(MOVIES_PATH)
+    movie_ids = selectable_ids()
+
+    # Content-based: rows of the neighbour table are catalogue rows
+    neighbours, scores = content_based.load_content_neighbours()
+    rows = catalogue.rows(movie_ids)
+    indexed = rows < len(neighbours)
+    width = min(k, neighbours.shape[1])
+    content_ids = np.full((len(rows), width), -1)
+    content_scores = np.full((len(rows), width), -np.inf)
+    content_ids[indexed] = catalogue.movie_ids[neighbours[rows[indexed], :width]]
+    content_scores[indexed] = scores[rows[indexed], :width]
+
+    # Collaborative: exact cosine search over the item factors
+    factors = collaborative_based.get_factors()
+    units = unit_rows(factors.qi)
+    item_rows = factors.item_rows(movie_ids)
+    collab_ids, collab_scores = [], []
+    for row in item_rows:
+        if row < 0:
+            collab_ids.append([])
+            collab_scores.append([])
+            continue
+        similarity = units @ units[row]
+        similarity[row] = -np.inf
+        best = top_k(similarity, k)
+        collab_ids.append(factors.item_ids[best])
+        collab_scores.append(similarity[best])
+
+    np.savez(path, movie_ids=movie_ids.astype(np.int32),
+             content_ids=content_ids.astype(np.int32),
+             content_scores=content_scores.astype(np.float32),
+             content_source=np.array(content_based.content_fingerprint()),
+             collab_ids=pad(collab_ids, k, -1).astype(np.int32),
+             collab_scores=pad(collab_scores, k, -np.inf).astype(np.float32),
+             collab_source=np.array(factors.fingerprint or ''))
+    print (f"Warm-up lookup completed. Saved to: {path}")
+
+@resource('warmup')
+def load_warmup():
+    """Load the precomputed lookup file.
+
+    Returns
+    -------
+    tuple (dict, dict) or None
+        Row of every selectable movie ID and the stored arrays, or None
+        if the lookup file has not been built.
+
+    """
+    if not os.path.exists(WARMUP_PATH):
+        return None
+    with np.load(WARMUP_PATH) as data:
+        arrays = {name: data[name] for name in data.files}
+    rows = {movie_id: row for row, movie_id in enumerate(arrays['movie_ids'].tolist())}
+    return rows, arrays
+
+def warm_neighbours(algorithm, movie_ids, source):
+    """Look up the precomputed neighbours of the chosen movies.
+
+    Parameters
+    ----------
+    algorithm : str
+        'content' or 'collab'.
+    movie_ids : list (int)
+        Movie IDs of the chosen movies.
+    source : str
+        Fingerprint of the index or model currently served by the
+        algorithm. Neighbours precomputed from another one are stale.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray) or None
+        Neighbour movie IDs and scores of every chosen movie (padded with
+        -1 and -inf), or None when the lookup file is missing or stale,
+        or a chosen movie is not selectable.
+
+    """
+    warmup = load_warmup()
+    if warmup is None or any(movie_id not in warmup[0] for movie_id in movie_ids):
+        return None
+    rows, arrays = warmup
+    if f'{algorithm}_source' not in arrays or str(arrays[f'{algorithm}_source']) != source:
+        return None
+    idx = [rows[movie_id] for movie_id in movie_ids]
+    return arrays[f'{algorithm}_ids'][idx], arrays[f'{algorithm}_scores'][idx]
+
+@timed('warmup.lookup')
+def warm_recommendations(algorithm, movie_ids, top_n, source):
+    """Answer a request from the precomputed lookup file.
+
+    Parameters
+    ----------
+    algorithm : str
+        'content' or 'collab'.
+    movie_ids : list (int)
+        Movie IDs of the chosen movies.
+    top_n : int
+        Number of movies to return.
+    source : str
+        Fingerprint of the index or model currently served by the
+        algorithm, see `warm_neighbours`.
+
+    Returns
+    -------
+    numpy.ndarray or None
+        Movie IDs of the recommended movies, best first, or None when the
+        lookup file cannot answer exactly: it is stale, a chosen movie is
+        not selectable or too few neighbours are stored.
+
+    """
+    found = warm_neighbours(algorithm, movie_ids, source)
+    if found is None:
+        return None
+    neighbours, scores = found
+    # Only the first k - len(movie_ids) + 1 merged neighbours are exact,
+    # as in the neighbour merge of `content_model`
+    exact = neighbours.shape[1] - len(movie_ids) + 1
+    if top_n > exact:
+        return None
+    found = neighbours >= 0
+    top_ids, _ = merge_neighbours(neighbours[found], scores[found],
+                                  exclude=movie_ids, n=exact)
+    # Keeping movies which have a title
+    top_ids = top_ids[load_catalogue(MOVIES_PATH).rows(top_ids) >= 0]
+    if len(top_ids) < top_n:
+        return None
+    return top_ids[:top_n]
+
+if __name__ == '__main__':
+    build_warmup()
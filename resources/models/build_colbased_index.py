@@ -0,0 +1,95 @@
+"""
+
+    Collaborative-based neighbour index construction.
+
+    Author: Explore Data Science Academy.
+
+    Description: Simple script to precompute, for every movie known to a
+    trained SVD model, its most similar movies according to the learned
+    item factors, and save them as fixed-width NumPy arrays which the app
+    memory-maps for serving. Both indexes record the fingerprint of the
+    model they were built from, and the app ignores them once the model
+    has changed (e.g. after new ratings were folded into it). Indexes are
+    never rewritten in place, so they can be rebuilt beside a running app.
+
+"""
+# Script dependencies
+import os
+import sys
+import time
+import json
+import pickle
+import numpy as np
+
+# Make the repository packages importable when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from utils.ranking import neighbour_table
+from utils.data_loader import save_array, write_json, remove_versions
+from recommenders.factor_model import FactorModel
+from recommenders.ann_index import IVFIndex, tune
+
+# Arrays of the collaborative neighbour index, by manifest key
+NEIGHBOUR_FILES = {'item_ids': 'collab_item_ids', 'indices': 'collab_neighbours',
+                   'scores': 'collab_neighbour_scores'}
+
+def load_factors(model_path):
+    # Exported parameter bundle, or the pickled model
+    if os.path.isdir(model_path):
+        return FactorModel.load(model_path)
+    return FactorModel.from_surprise(pickle.load(open(model_path, 'rb')),
+                                     FactorModel.pickle_fingerprint(model_path))
+
+def item_neighbours(model_path, save_dir, k=100, chunk_size=512):
+    # Loading the trained model
+    factors = load_factors(model_path)
+    # Cosine similarity between item factors
+    norms = np.linalg.norm(factors.qi, axis=1, keepdims=True)
+    qi = (factors.qi / np.where(norms == 0, 1, norms)).astype(np.float32)
+    n, k = len(qi), min(k, len(qi) - 1)
+    # Every build writes new files, published by replacing the manifest
+    # which names them (see `remove_versions`), so that running apps keep
+    # reading the arrays they mapped and an interrupted build is ignored
+    version = f'{time.time_ns():x}'
+    files = {key: f'{name}.{version}.npy' for key, name in NEIGHBOUR_FILES.items()}
+    save_array(os.path.join(save_dir, files['item_ids']), factors.item_ids.astype(np.int64))
+    # Neighbours are written block by block straight into the output files
+    out = (np.lib.format.open_memmap(os.path.join(save_dir, files['indices']),
+                                     mode='w+', dtype=np.int32, shape=(n, k)),
+           np.lib.format.open_memmap(os.path.join(save_dir, files['scores']),
+                                     mode='w+', dtype=np.float32, shape=(n, k)))
+    neighbour_table(qi, k, chunk_size, out=out)
+    for array in out:
+        array.flush()
+    del out
+    manifest_path = os.path.join(save_dir, 'collab_neighbours.json')
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f).get('files', {})
+    write_json(manifest_path, dict(source=factors.fingerprint or '', k=k, files=files))
+    # The previous version is kept for readers which loaded its manifest
+    # just before it was replaced
+    for key, name in NEIGHBOUR_FILES.items():
+        remove_versions(save_dir, name, keep={files[key], previous.get(key)})
+    print (f"Neighbour index completed. Saved to: {save_dir}")
+
+def ann_index(model_path, save_path, n_lists=None, target_recall=0.9):
+    # Loading the trained model
+    factors = load_factors(model_path)
+    # Partitioning the item factors for cosine search
+    index = IVFIndex.build(factors.qi, factors.item_ids, n_lists=n_lists,
+                           source=factors.fingerprint or '')
+    # Probe count reaching the target recall against exact search, saved
+    # with the index
+    result = tune(index, target_recall, k=10)
+    index.save(save_path)
+    print (f"ANN index completed. Saving index to: {save_path}")
+    print (f"n_probe: {result['n_probe']} of {len(index.centroids)}, "
+           f"recall@10: {result['recall']:.3f}, "
+           f"exact: {result['exact_ms']:.3f} ms/query, ann: {result['ann_ms']:.3f} ms/query")
+    return result
+
+if __name__ == '__main__':
+    model_path = 'svd_factors' if FactorModel.exists('svd_factors') else 'svd_model.pkl'
+    item_neighbours(model_path, '.')
+    ann_index(model_path, 'svd_ann.npz')
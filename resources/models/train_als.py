@@ -0,0 +1,446 @@
+"""
+
+    Alternating least squares (ALS) model training.
+
+    Author: Explore Data Science Academy.
+
+    Description: Simple script to factorise the MovieLens ratings with a
+    biased alternating least squares, using NumPy only. The learned
+    parameters are the same as those of Surprise's `SVD` (`pu`, `qi`,
+    `bu`, `bi` and the global mean) and are saved as the bundle of NumPy
+    arrays which the app memory-maps for serving.
+
+    Every half-sweep fixes one side of the model and solves the regularised
+    least-squares problem of every user (or item). Users with a
+    similar number of ratings are solved together as one stack of
+    BLAS-backed matrix products and linear solves, and stacks are spread
+    over a pool of threads. During training, every solve is a few
+    conjugate gradient steps started from the previous sweep, which only
+    read the ratings a few times instead of forming and factorising a
+    system per user (or item). Folding in new ratings solves exactly:
+
+        python train_als.py --ratings ratings.csv --n-factors 100
+
+    New ratings can be folded into a saved model in seconds, solving only
+    for the users and movies they concern, until the next full training.
+    The collaborative neighbour indexes saved next to the model are then
+    rebuilt, and the app ignores the warm-up lookups until they are:
+
+        python train_als.py --ratings ratings.csv --fold-in new_ratings.csv
+
+    The accuracy of the ALS model can be compared to that of the current
+    SVD on the same holdout split with:
+
+        python train_als.py --ratings ratings.csv --parity
+
+"""
+# Script dependencies
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Make the repository packages, and the other training scripts,
+# importable when run as a script from any directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from recommenders.factor_model import FactorModel
+from utils.data_loader import load_ratings
+
+# Vectors of `dim` entries held per owner while solving, counted as
+# ratings towards the size of a stack
+SOLVER_VECTORS = 8
+
+def solve_groups(counts, dim, max_rows=1 << 14, max_gram=1 << 22, growth=1.25):
+    # Owners sorted by number of ratings, cut into stacks of at most
+    # `max_rows` (padded) ratings, plus `SOLVER_VECTORS` per owner, and
+    # `max_gram` entries of the stacked
+    # systems, which are min(ratings, dim) square (see `HalfSweep`). A
+    # stack also ends where the number of ratings outgrows its first
+    # owner's by `growth` (bounding the padding), or reaches `dim`
+    order = np.argsort(counts, kind='stable')
+    sizes = np.maximum(counts[order], 1)
+    systems = np.minimum(sizes, dim) ** 2
+    groups, start = [], 0
+    for end in range(1, len(order) + 1):
+        if (end == len(order) or (end + 1 - start) * (sizes[end] + SOLVER_VECTORS) > max_rows
+                or (end + 1 - start) * systems[end] > max_gram
+                or sizes[end] > growth * sizes[start] + 1
+                or (sizes[start] < dim) != (sizes[end] < dim)):
+            groups.append(order[start:end])
+            start = end
+    return groups
+
+class HalfSweep:
+    """Least-squares solve of one side of the model, given the other.
+
+    For every owner (a user, or an item) the parameters ``x = [factors,
+    bias]`` minimise ``sum((t - z . x) ** 2) + reg * n * |x| ** 2`` over
+    its `n` ratings, where `z` holds the fixed ``[factors, 1]`` of the
+    other side and `t` is the rating less the global mean and the bias of
+    the other side.
+
+    With ``Z`` the ``n x d`` ratings of an owner, the solution is
+    ``(Z'Z + l I)^-1 Z't``, with ``l = reg * n``, and equally
+    ``Z' (ZZ' + l I)^-1 t``. Exact solves use the second (dual) form,
+    which only needs an ``n x n`` system, when `n` is below `d`.
+    Conjugate gradient steps apply ``Z'Z + l I`` to a vector as
+    ``Z'(Z p) + l p``, without forming it.
+
+    Parameters
+    ----------
+    owners : numpy.ndarray
+        Row of the owner of every rating.
+    others : numpy.ndarray
+        Row of the other side of every rating.
+    n_owners : int
+        Number of owners.
+    dim : int
+        Number of parameters per owner (factors plus bias).
+    max_rows : int
+        Largest number of (padded) ratings solved as one stack.
+    max_gram : int
+        Largest number of entries of the systems solved as one stack.
+
+    """
+
+    def __init__(self, owners, others, n_owners, dim, max_rows=1 << 14, max_gram=1 << 22):
+        order = np.argsort(owners, kind='stable')
+        self.order = order
+        self.others = others[order]
+        self.counts = np.bincount(owners, minlength=n_owners)
+        self.indptr = np.concatenate([[0], np.cumsum(self.counts)])
+        self.groups = solve_groups(self.counts, dim, max_rows, max_gram)
+
+    def solve_group(self, group, features, targets, reg, out, init=None, cg_steps=None):
+        counts = self.counts[group]
+        width = max(int(counts.max()), 1)
+        # Ratings of every owner, padded with zero rows to the same width
+        offsets = np.arange(width)
+        mask = offsets[None, :] < counts[:, None]
+        positions = np.where(mask, self.indptr[group][:, None] + offsets[None, :], 0)
+        z = features[self.others[positions]]
+        z *= mask[..., None]
+        t = targets[positions] * mask
+        zt = z.transpose(0, 2, 1)
+        ridge = (reg * np.maximum(counts, 1))[:, None]
+        if cg_steps:
+            out[group] = conjugate_gradient(z, zt, t, ridge, init[group], cg_steps)
+            return
+        # Padded ratings are zero rows of z and t, which leave the primal
+        # solution unchanged and get a zero dual variable
+        dual = width < z.shape[2]
+        gram = z @ zt if dual else zt @ z
+        diagonal = np.arange(gram.shape[1])
+        gram[:, diagonal, diagonal] += ridge
+        if dual:
+            out[group] = (zt @ np.linalg.solve(gram, t[..., None]))[..., 0]
+        else:
+            out[group] = np.linalg.solve(gram, zt @ t[..., None])[..., 0]
+
+    def solve(self, features, targets, reg, pool, init=None, cg_steps=None):
+        """Solve every owner for the fixed `features` of the other side and
+           the `targets` of every rating, in the order of the ratings.
+
+        Solves are exact, or `cg_steps` conjugate gradient steps from the
+        parameters `init` of every owner.
+        """
+        out = np.empty((len(self.counts), features.shape[1]))
+        targets = targets[self.order]
+        list(pool.map(lambda group: self.solve_group(group, features, targets, reg, out,
+                                                     init, cg_steps),
+                      self.groups))
+        return out
+
+def conjugate_gradient(z, zt, t, ridge, x, steps):
+    # Batched conjugate gradient on (Z'Z + ridge I) x = Z't, one system
+    # per owner, from the initial parameters `x`
+    def apply(p):
+        return (zt @ (z @ p[..., None]))[..., 0] + ridge * p
+    tiny = np.finfo(np.float64).tiny
+    x = x.copy()
+    r = (zt @ t[..., None])[..., 0] - apply(x)
+    p = r.copy()
+    rs = np.einsum('ij,ij->i', r, r)
+    for _ in range(steps):
+        ap = apply(p)
+        alpha = rs / np.maximum(np.einsum('ij,ij->i', p, ap), tiny)
+        x += alpha[:, None] * p
+        r -= alpha[:, None] * ap
+        rs, previous = np.einsum('ij,ij->i', r, r), rs
+        p = r + (rs / np.maximum(previous, tiny))[:, None] * p
+    return x
+
+def train_als(user_ids, item_ids, ratings, n_factors=100, reg=0.05, n_epochs=6,
+              init_std_dev=0.1, rating_scale=None, n_threads=None, seed=0,
+              cg_steps=3, verbose=True):
+    """Fit a biased matrix-factorisation model with alternating least squares.
+
+    Parameters
+    ----------
+    user_ids : numpy.ndarray
+        Raw user ID of every rating.
+    item_ids : numpy.ndarray
+        Raw movie ID of every rating.
+    ratings : numpy.ndarray
+        Rating values.
+    n_factors : int
+        Number of latent factors.
+    reg : float
+        Regularisation of the factors and biases, per rating.
+    n_epochs : int
+        Number of (user, item) sweeps.
+    init_std_dev : float
+        Standard deviation of the initial item factors.
+    rating_scale : tuple (float, float)
+        Lowest and highest possible ratings, defaults to the observed ones.
+    n_threads : int
+        Number of threads solving stacks concurrently, defaults to the
+        number of CPUs.
+    seed : int
+        Seed of the initial item factors.
+    cg_steps : int or None
+        Number of conjugate gradient steps per solve, warm-started from
+        the previous sweep. None solves every user and item exactly.
+    verbose : bool
+        Print the training RMSE after every sweep.
+
+    Returns
+    -------
+    FactorModel
+        The learned parameters.
+
+    """
+    raw_users, users = np.unique(user_ids, return_inverse=True)
+    raw_items, items = np.unique(item_ids, return_inverse=True)
+    ratings = np.asarray(ratings, dtype=np.float64)
+    global_mean = ratings.mean()
+    if rating_scale is None:
+        rating_scale = (float(ratings.min()), float(ratings.max()))
+    user_sweep = HalfSweep(users, items, len(raw_users), n_factors + 1)
+    item_sweep = HalfSweep(items, users, len(raw_items), n_factors + 1)
+
+    rng = np.random.default_rng(seed)
+    qi = rng.normal(0, init_std_dev, (len(raw_items), n_factors))
+    bi = np.zeros(len(raw_items))
+    # Parameters [factors, bias] of every user and item
+    x_users = np.zeros((len(raw_users), n_factors + 1))
+    x_items = np.column_stack([qi, bi])
+    with ThreadPoolExecutor(n_threads or os.cpu_count()) as pool:
+        for epoch in range(n_epochs):
+            start = time.perf_counter()
+            # Users against fixed items, then items against fixed users
+            x_users = user_sweep.solve(np.column_stack([qi, np.ones(len(qi))]),
+                                       ratings - global_mean - bi[items], reg, pool,
+                                       x_users, cg_steps)
+            pu, bu = x_users[:, :-1], x_users[:, -1]
+            x_items = item_sweep.solve(np.column_stack([pu, np.ones(len(pu))]),
+                                       ratings - global_mean - bu[users], reg, pool,
+                                       x_items, cg_steps)
+            qi, bi = x_items[:, :-1], x_items[:, -1]
+            if verbose:
+                est = global_mean + bu[users] + bi[items] + np.einsum('ij,ij->i', pu[users], qi[items])
+                rmse = np.sqrt(np.mean((ratings - est) ** 2))
+                print (f"Epoch {epoch + 1}: train rmse {rmse:.4f}, "
+                       f"{time.perf_counter() - start:.1f} s")
+    return FactorModel(np.ascontiguousarray(pu), np.ascontiguousarray(qi), bu, bi,
+                       global_mean, raw_users, raw_items, rating_scale)
+
+def grow(factors, biases, ids, new_ids):
+    # Zero parameters appended for the IDs unknown to the model
+    added = np.setdiff1d(np.unique(new_ids), ids)
+    return (np.vstack([factors, np.zeros((len(added), factors.shape[1]))]),
+            np.concatenate([biases, np.zeros(len(added))]),
+            np.concatenate([ids, added.astype(ids.dtype)]))
+
+def fold_half(owner_rows, other_rows, targets, features, reg, out_factors, out_biases, pool):
+    # Solve the owners of the given ratings against the fixed other side,
+    # skipping ratings of the other side unknown to the model
+    known = other_rows >= 0
+    owners, local = np.unique(owner_rows[known], return_inverse=True)
+    sweep = HalfSweep(local, other_rows[known], len(owners), features.shape[1])
+    x = sweep.solve(features, targets[known], reg, pool)
+    out_factors[owners], out_biases[owners] = x[:, :-1], x[:, -1]
+
+def fold_in(model, user_ids, item_ids, ratings, users, items, reg=0.05, n_threads=None):
+    """Update a trained model for new ratings without retraining it.
+
+    The given users are solved against the fixed item factors, then the
+    given items against the updated user factors, as in one sweep of
+    `train_als` restricted to them. Users and items unknown to the model
+    are appended to it. The global mean is left unchanged.
+
+    Parameters
+    ----------
+    model : FactorModel
+        Trained model.
+    user_ids : numpy.ndarray
+        Raw user ID of every rating of the users and items to update.
+    item_ids : numpy.ndarray
+        Raw movie ID of every rating of the users and items to update.
+    ratings : numpy.ndarray
+        Rating values.
+    users : array-like
+        Raw IDs of the users to update.
+    items : array-like
+        Raw IDs of the movies to update.
+    reg : float
+        Regularisation of the factors and biases, per rating.
+    n_threads : int
+        Number of threads solving stacks concurrently, defaults to the
+        number of CPUs.
+
+    Returns
+    -------
+    FactorModel
+        The updated model.
+
+    """
+    ratings = np.asarray(ratings, dtype=np.float64)
+    trained = model
+    pu, bu, raw_users = grow(trained.pu, trained.bu, trained.user_ids, users)
+    qi, bi, raw_items = grow(trained.qi, trained.bi, trained.item_ids, items)
+    model = FactorModel(pu, qi, bu, bi, trained.global_mean, raw_users, raw_items,
+                        trained.rating_scale)
+    with ThreadPoolExecutor(n_threads or os.cpu_count()) as pool:
+        # Users against fixed items, skipping new items (no factors yet)
+        sel = np.isin(user_ids, users)
+        item_rows = trained.item_rows(item_ids[sel])
+        fold_half(model.user_rows(user_ids[sel]), item_rows,
+                  ratings[sel] - model.global_mean - model.bi[item_rows],
+                  np.column_stack([qi, np.ones(len(qi))]), reg, pu, bu, pool)
+        # Items against the updated users
+        sel = np.isin(item_ids, items)
+        user_rows = model.user_rows(user_ids[sel])
+        fold_half(model.item_rows(item_ids[sel]), user_rows,
+                  ratings[sel] - model.global_mean - model.bu[user_rows],
+                  np.column_stack([pu, np.ones(len(pu))]), reg, qi, bi, pool)
+    return model
+
+def als(ratings_path, factors_dir='svd_factors', **params):
+    # Compact memory-mapped rating columns
+    ratings = load_ratings(ratings_path)
+    start = time.perf_counter()
+    model = train_als(ratings['userId'].to_numpy(), ratings['movieId'].to_numpy(),
+                      ratings['rating'].to_numpy(), **params)
+    print (f"Training completed in {time.perf_counter() - start:.1f} s. "
+           f"Saving model to: {factors_dir}")
+    model.save(factors_dir)
+    return model
+
+def update(ratings_path, new_ratings_path, factors_dir='svd_factors', reg=0.05,
+           n_threads=None):
+    # Every rating of the users and movies of the new ratings, the new
+    # ones replacing earlier ratings of the same movie by the same user
+    new = pd.read_csv(new_ratings_path, usecols=['userId', 'movieId', 'rating'])
+    users, items = new['userId'].unique(), new['movieId'].unique()
+    ratings = load_ratings(ratings_path)
+    sel = ratings['userId'].isin(users) | ratings['movieId'].isin(items)
+    history = pd.concat([ratings[sel], new], ignore_index=True)
+    history = history.drop_duplicates(['userId', 'movieId'], keep='last')
+
+    start = time.perf_counter()
+    model = fold_in(FactorModel.load(factors_dir, mmap_mode=None),
+                    history['userId'].to_numpy(), history['movieId'].to_numpy(),
+                    history['rating'].to_numpy(), users, items, reg, n_threads)
+    print (f"Folded in {len(new)} ratings of {len(users)} users and {len(items)} movies "
+           f"in {time.perf_counter() - start:.1f} s. Saving model to: {factors_dir}")
+    model.save(factors_dir)
+
+    # Indexes of the previous parameters are ignored by the app (their
+    # source no longer matches the model) until rebuilt
+    from build_colbased_index import item_neighbours, ann_index
+    models_dir = os.path.dirname(os.path.abspath(factors_dir))
+    table_path = os.path.join(models_dir, 'collab_neighbours.json')
+    if os.path.exists(table_path):
+        with open(table_path) as f:
+            item_neighbours(factors_dir, models_dir, k=json.load(f)['k'])
+    if os.path.exists(os.path.join(models_dir, 'svd_ann.npz')):
+        ann_index(factors_dir, os.path.join(models_dir, 'svd_ann.npz'))
+    print ("Rebuild the warm-up lookups with `python -m recommenders.warmup` "
+           "from the root of the repository.")
+    return model
+
+def parity(ratings_path, test_size=0.2, seed=42, tolerance=0.02, svd_params=None, **params):
+    """Compare the holdout RMSE of the ALS model with that of Surprise's
+       `SVD`, trained on the same ratings with the served hyper-parameters.
+
+    Returns
+    -------
+    dict
+        RMSE of both models, and whether the ALS model is at most
+        `tolerance` worse than the SVD.
+
+    """
+    from surprise import SVD, Reader, Dataset
+    from train_colbased import DEFAULT_PARAMS
+
+    ratings = load_ratings(ratings_path)
+    users = ratings['userId'].to_numpy()
+    items = ratings['movieId'].to_numpy()
+    values = ratings['rating'].to_numpy().astype(np.float64)
+    rating_scale = (float(values.min()), float(values.max()))
+    test = np.random.default_rng(seed).random(len(values)) < test_size
+    train = ~test
+
+    results = {}
+    start = time.perf_counter()
+    model = train_als(users[train], items[train], values[train],
+                      rating_scale=rating_scale, verbose=False, **params)
+    results['als_fit_seconds'] = time.perf_counter() - start
+    results['als_rmse'] = rmse(model, users[test], items[test], values[test])
+
+    frame = ratings[train].reset_index(drop=True)
+    trainset = Dataset.load_from_df(frame, Reader(rating_scale=rating_scale)).build_full_trainset()
+    start = time.perf_counter()
+    svd = SVD(init_std_dev=0.05, random_state=seed,
+              **dict(DEFAULT_PARAMS, **(svd_params or {}))).fit(trainset)
+    results['svd_fit_seconds'] = time.perf_counter() - start
+    results['svd_rmse'] = rmse(FactorModel.from_surprise(svd), users[test], items[test], values[test])
+
+    results['parity'] = bool(results['als_rmse'] <= results['svd_rmse'] + tolerance)
+    for name in ('als', 'svd'):
+        print (f"{name}: rmse {results[name + '_rmse']:.4f}, "
+               f"fit {results[name + '_fit_seconds']:.1f} s")
+    print (f"Parity within {tolerance}: {results['parity']}")
+    return results
+
+def rmse(model, user_ids, item_ids, ratings):
+    return float(np.sqrt(np.mean((model.estimate(user_ids, item_ids) - ratings) ** 2)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train the served model with ALS.")
+    parser.add_argument('--ratings', default='ratings.csv')
+    parser.add_argument('--factors-dir', default='svd_factors')
+    parser.add_argument('--n-factors', type=int, default=100)
+    parser.add_argument('--reg', type=float, default=0.05)
+    parser.add_argument('--n-epochs', type=int, default=6)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cg-steps', type=int, default=3,
+                        help="conjugate gradient steps per solve, 0 for exact solves")
+    parser.add_argument('--parity', action='store_true',
+                        help="compare the holdout RMSE with Surprise's SVD instead of training")
+    parser.add_argument('--tolerance', type=float, default=0.02)
+    parser.add_argument('--fold-in', metavar='NEW_RATINGS',
+                        help="update the saved model for the ratings of this CSV file "
+                             "instead of training")
+    args = parser.parse_args(argv)
+
+    if args.fold_in:
+        update(args.ratings, args.fold_in, args.factors_dir, args.reg, args.threads)
+        return
+
+    params = dict(n_factors=args.n_factors, reg=args.reg, n_epochs=args.n_epochs,
+                  n_threads=args.threads, seed=args.seed, cg_steps=args.cg_steps or None)
+    if args.parity:
+        results = parity(args.ratings, tolerance=args.tolerance, **params)
+        sys.exit(0 if results['parity'] else 1)
+    als(args.ratings, args.factors_dir, **params)
+
+if __name__ == '__main__':
+    main()
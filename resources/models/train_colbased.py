@@ -5,35 +5,181 @@
     Author: Explore Data Science Academy.
 
     Description: Simple script to train and save an instance of the
-    SVDpp algorithm on MovieLens data.
+    SVDpp algorithm on MovieLens data, both pickled and as a bundle of
+    NumPy arrays which the app memory-maps for serving.
+
+    A grid of hyper-parameters can be evaluated on a holdout split across
+    a pool of processes before the best configuration is trained on all
+    ratings. Every evaluated configuration is appended to a checkpoint
+    file, so that an interrupted search resumes where it stopped:
+
+        python train_colbased.py --n-factors 100 200 --reg-all 0.02 0.05
 
 """
 # Script dependencies
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import pandas as pd
-from surprise import SVD
+from surprise import SVD, accuracy
+from surprise.model_selection import train_test_split
 import surprise
 import pickle
 
+# Make the repository packages importable when run as a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from recommenders.factor_model import FactorModel
+from utils.data_loader import csv_fingerprint
+
+# Hyper-parameters of the served model
+DEFAULT_PARAMS = dict(n_factors=200, lr_all=0.005, reg_all=0.02, n_epochs=40)
+
 # Importing datasets
-ratings = pd.read_csv('ratings.csv')
-ratings.drop('timestamp',axis=1,inplace=True)
+def read_ratings(path='ratings.csv'):
+    ratings = pd.read_csv(path)
+    ratings.drop('timestamp',axis=1,inplace=True)
+    return ratings
 
-def svd_pp(save_path):
+def load_dataset(ratings):
     # Check the range of the rating
     min_rat = ratings['rating'].min()
     max_rat = ratings['rating'].max()
     # Changing ratings to their standard form
     reader = surprise.Reader(rating_scale = (min_rat,max_rat))
     # Loading the data frame using surprice
-    data_load = surprise.Dataset.load_from_df(ratings, reader)
+    return surprise.Dataset.load_from_df(ratings, reader)
+
+def svd_pp(save_path, factors_dir='svd_factors', params=None,
+           ratings_path='ratings.csv', random_state=None):
+    data_load = load_dataset(read_ratings(ratings_path))
     # Insatntiating surpricce
-    method = SVD(n_factors = 200 , lr_all = 0.005 , reg_all = 0.02 , n_epochs = 40 , init_std_dev = 0.05)
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    method = SVD(init_std_dev = 0.05, random_state = random_state, **params)
     # Loading a trainset into the model
     model = method.fit(data_load.build_full_trainset())
     print (f"Training completed. Saving model to: {save_path}")
+    # Exporting the learned parameters for memory-mapped serving
+    FactorModel.from_surprise(model).save(factors_dir)
+    print (f"Model parameters exported to: {factors_dir}")
 
     return pickle.dump(model, open(save_path,'wb'))
 
+def param_grid(n_factors, lr_all, reg_all, n_epochs):
+    # Every combination of the given values
+    return [dict(n_factors=f, lr_all=lr, reg_all=reg, n_epochs=e)
+            for f, lr, reg, e in itertools.product(n_factors, lr_all, reg_all, n_epochs)]
+
+def config_key(params):
+    return json.dumps(params, sort_keys=True)
+
+# Holdout split of the worker process, see `init_worker`
+holdout = None
+
+def init_worker(ratings_path, test_size, seed):
+    # Each worker reads and splits the ratings once, for all its runs
+    global holdout
+    data_load = load_dataset(read_ratings(ratings_path))
+    holdout = train_test_split(data_load, test_size=test_size, random_state=seed)
+
+def evaluate(params, seed):
+    trainset, testset = holdout
+    start = time.perf_counter()
+    model = SVD(init_std_dev = 0.05, random_state = seed, **params).fit(trainset)
+    fit_seconds = time.perf_counter() - start
+    rmse = accuracy.rmse(model.test(testset), verbose=False)
+    return dict(params=params, fit_seconds=fit_seconds, rmse=rmse)
+
+def read_checkpoint(checkpoint_path, data):
+    # Results of earlier runs on the same ratings and split
+    results = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # Partially written line of an interrupted run
+                    continue
+                if result.get('data') == data:
+                    results[config_key(result['params'])] = result
+    return results
+
+def grid_search(grid, ratings_path, checkpoint_path, max_workers=None,
+                test_size=0.2, seed=42):
+    """Evaluate hyper-parameter configurations in parallel.
+
+    Parameters
+    ----------
+    grid : list (dict)
+        Keyword arguments of `surprise.SVD` for every configuration.
+    ratings_path : str
+        Ratings CSV file.
+    checkpoint_path : str
+        JSON lines file the result of every configuration is appended to
+        as soon as it completes. Configurations already evaluated on the
+        same ratings file and split are not run again.
+    max_workers : int
+        Number of processes, defaults to the number of CPUs.
+    test_size : float
+        Fraction of the ratings held out to compute the RMSE.
+    seed : int
+        Seed of the holdout split and of the model initialisation.
+
+    Returns
+    -------
+    list (dict)
+        Parameters, fit wall-time in seconds and holdout RMSE of every
+        configuration, in the order of `grid`.
+
+    """
+    data = dict(source=csv_fingerprint(ratings_path), test_size=test_size, seed=seed)
+    results = read_checkpoint(checkpoint_path, data)
+    pending = [params for params in grid if config_key(params) not in results]
+    print (f"{len(grid) - len(pending)} of {len(grid)} configurations already evaluated")
+    if pending:
+        max_workers = min(max_workers or os.cpu_count(), len(pending))
+        with ProcessPoolExecutor(max_workers, initializer=init_worker,
+                                 initargs=(ratings_path, test_size, seed)) as pool, \
+                open(checkpoint_path, 'a') as checkpoint:
+            futures = [pool.submit(evaluate, params, seed) for params in pending]
+            for future in as_completed(futures):
+                result = dict(future.result(), data=data)
+                checkpoint.write(json.dumps(result) + '\n')
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+                results[config_key(result['params'])] = result
+                print (f"{config_key(result['params'])}: rmse {result['rmse']:.4f}, "
+                       f"fit {result['fit_seconds']:.1f} s")
+    return [results[config_key(params)] for params in grid]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train the SVD model served by the app.")
+    parser.add_argument('--ratings', default='ratings.csv')
+    parser.add_argument('--save-path', default='SVD.pkl')
+    parser.add_argument('--factors-dir', default='svd_factors')
+    parser.add_argument('--checkpoint', default='train_colbased_grid.jsonl')
+    parser.add_argument('--n-factors', type=int, nargs='+', default=[DEFAULT_PARAMS['n_factors']])
+    parser.add_argument('--lr-all', type=float, nargs='+', default=[DEFAULT_PARAMS['lr_all']])
+    parser.add_argument('--reg-all', type=float, nargs='+', default=[DEFAULT_PARAMS['reg_all']])
+    parser.add_argument('--n-epochs', type=int, nargs='+', default=[DEFAULT_PARAMS['n_epochs']])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--test-size', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+
+    grid = param_grid(args.n_factors, args.lr_all, args.reg_all, args.n_epochs)
+    results = grid_search(grid, args.ratings, args.checkpoint, args.workers,
+                          args.test_size, args.seed)
+    best = min(results, key=lambda result: result['rmse'])
+    print (f"Best configuration: {config_key(best['params'])} (rmse {best['rmse']:.4f})")
+    # Training the best configuration on all ratings
+    svd_pp(args.save_path, args.factors_dir, best['params'], args.ratings, args.seed)
+    return best
+
 if __name__ == '__main__':
-    svd_pp('SVD.pkl')
+    main()
@@ -6,9 +6,240 @@
 
 """
 # Data handling dependencies
+import os
+import json
+import hashlib
+import inspect
+import functools
 import pandas as pd
 import numpy as np
+from utils.instrumentation import timed
 
+# Shared data files and the compact dtypes they are loaded with
+MOVIES_PATH = 'resources/data/movies.csv'
+RATINGS_PATH = 'resources/data/ratings.csv'
+MOVIES_DTYPES = {'movieId': np.int32, 'title': object, 'genres': 'category'}
+RATINGS_DTYPES = {'userId': np.int32, 'movieId': np.int32, 'rating': np.float32,
+                  'timestamp': np.int64}
+
+def cached_by_path(loader):
+    """Cache the result of a loader of one file, once per process.
+
+    Unlike `functools.lru_cache`, the key is the absolute path of the file,
+    so that `load_catalogue()` and `load_catalogue(MOVIES_PATH)` share one
+    result.
+    """
+    cached = functools.lru_cache(maxsize=None)(loader)
+    default = next(iter(inspect.signature(loader).parameters.values())).default
+
+    @functools.wraps(loader)
+    def wrapper(path=default):
+        return cached(os.path.abspath(path))
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+def cache_paths(path_to_csv):
+    """Locate the binary cache of a CSV file.
+
+    The cache lives in a `cache` folder next to the CSV file.
+
+    Parameters
+    ----------
+    path_to_csv : str
+        Relative or absolute path to the source .csv file.
+
+    Returns
+    -------
+    tuple (str, str)
+        Path prefix of the cached files and path of the cache manifest.
+
+    """
+    name = os.path.splitext(os.path.basename(path_to_csv))[0]
+    prefix = os.path.join(os.path.dirname(path_to_csv), 'cache', name)
+    return prefix, prefix + '.json'
+
+def csv_fingerprint(path_to_csv):
+    """Identify the version of a CSV file by its size and modification time."""
+    stat = os.stat(path_to_csv)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def read_manifest(path_to_csv):
+    """Read the cache manifest of a CSV file.
+
+    Returns
+    -------
+    dict or None
+        The manifest, or None when the cache is missing or stale.
+
+    """
+    _, manifest_path = cache_paths(path_to_csv)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('source') != csv_fingerprint(path_to_csv):
+        return None
+    return manifest
+
+def write_manifest(path_to_csv, fingerprint, **fields):
+    """Write the cache manifest of a CSV file, marking the cache as usable."""
+    _, manifest_path = cache_paths(path_to_csv)
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(source=fingerprint, **fields), f)
+    os.replace(tmp_path, manifest_path)
+
+def save_array(path, array):
+    """Write an array to a .npy file aside, then rename it over `path`.
+
+    The previous file is unlinked rather than truncated, so processes
+    still memory-mapping it keep reading it unchanged.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+def write_json(path, value):
+    """Write a JSON file aside, then rename it over `path`."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f, indent=2)
+    os.replace(tmp_path, path)
+
+def remove_versions(directory, name, keep):
+    """Remove the versions `<name>.<version>.npy` of an array, except the
+       files named in `keep`.
+
+    Sets of arrays which must be read together (e.g. a factor bundle) are
+    written as new versioned files and published by atomically replacing
+    the manifest naming them, so that a reader never pairs arrays of two
+    versions. Earlier versions are then removed, which unlinks them
+    without disturbing processes still memory-mapping them.
+    """
+    for file in os.listdir(directory):
+        version = file[len(name) + 1:-len('.npy')]
+        if (file.startswith(name + '.') and file.endswith('.npy') and '.' not in version
+                and file not in keep):
+            try:
+                os.remove(os.path.join(directory, file))
+            except OSError:
+                # Still open elsewhere, on platforms which forbid removing it
+                pass
+
+@timed('data.convert_ratings')
+def convert_ratings(path_to_ratings=RATINGS_PATH):
+    """Convert the ratings CSV into one .npy file per column.
+
+    Parameters
+    ----------
+    path_to_ratings : str
+        Relative or absolute path to the ratings stored in .csv format.
+
+    Returns
+    -------
+    Pandas DataFrame
+        The ratings read from the CSV file, including timestamps.
+
+    """
+    fingerprint = csv_fingerprint(path_to_ratings)
+    df = pd.read_csv(path_to_ratings, dtype=RATINGS_DTYPES)
+    prefix, _ = cache_paths(path_to_ratings)
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    for column in df.columns:
+        save_array(f'{prefix}.{column}.npy', df[column].to_numpy())
+    write_manifest(path_to_ratings, fingerprint, columns=list(df.columns))
+    return df
+
+@timed('data.convert_movies')
+def convert_movies(path_to_movies=MOVIES_PATH):
+    """Convert the movies CSV into a binary table.
+
+    Parameters
+    ----------
+    path_to_movies : str
+        Relative or absolute path to movie database stored
+        in .csv format.
+
+    Returns
+    -------
+    Pandas DataFrame
+        The movies read from the CSV file.
+
+    """
+    fingerprint = csv_fingerprint(path_to_movies)
+    df = pd.read_csv(path_to_movies, dtype=MOVIES_DTYPES)
+    prefix, _ = cache_paths(path_to_movies)
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    table_path = save_frame(df, prefix)
+    write_manifest(path_to_movies, fingerprint, table=os.path.basename(table_path))
+    return df
+
+@cached_by_path
+@timed('data.load_movies')
+def load_movies(path_to_movies=MOVIES_PATH):
+    """Load the movie database records, once per process.
+
+    Records are read from the binary cache, which is (re)built from the
+    CSV file when it is missing or stale.
+
+    Parameters
+    ----------
+    path_to_movies : str
+        Relative or absolute path to movie database stored
+        in .csv format.
+
+    Returns
+    -------
+    Pandas DataFrame
+        movieId, title and genres of every complete record. The frame is
+        shared by all callers and must not be modified.
+
+    """
+    df = None
+    if read_manifest(path_to_movies) is not None:
+        df = load_frame(cache_paths(path_to_movies)[0])
+    if df is None:
+        try:
+            df = convert_movies(path_to_movies)
+        except OSError:
+            df = pd.read_csv(path_to_movies, dtype=MOVIES_DTYPES)
+    df = df.dropna().reset_index(drop=True)
+    return df
+
+@cached_by_path
+@timed('data.load_ratings')
+def load_ratings(path_to_ratings=RATINGS_PATH):
+    """Load the user ratings (without timestamps), once per process.
+
+    The columns are memory-mapped from the binary cache, so they load in
+    constant time and their pages are shared between processes. The cache
+    is (re)built from the CSV file when it is missing or stale.
+
+    Parameters
+    ----------
+    path_to_ratings : str
+        Relative or absolute path to the ratings stored in .csv format.
+
+    Returns
+    -------
+    Pandas DataFrame
+        userId, movieId and rating of every rating. The frame is shared
+        by all callers and must not be modified.
+
+    """
+    columns = ['userId', 'movieId', 'rating']
+    if read_manifest(path_to_ratings) is None:
+        try:
+            convert_ratings(path_to_ratings)
+        except OSError:
+            return pd.read_csv(path_to_ratings, usecols=columns, dtype=RATINGS_DTYPES)
+    prefix, _ = cache_paths(path_to_ratings)
+    df = pd.DataFrame({column: np.load(f'{prefix}.{column}.npy', mmap_mode='r')
+                       for column in columns}, copy=False)
+    return df
+
+@functools.lru_cache(maxsize=None)
+@timed('data.load_movie_titles')
 def load_movie_titles(path_to_movies):
     """Load movie titles from database records.
 
@@ -24,7 +255,154 @@ def load_movie_titles(path_to_movies):
         Movie titles.
 
     """
-    df = pd.read_csv(path_to_movies)
-    df = df.dropna()
-    movie_list = df['title'].to_list()
+    movie_list = load_movies(path_to_movies)['title'].to_list()
     return movie_list
+
+class Catalogue:
+    """Constant-time lookups between movie titles, movie IDs and rows.
+
+    Rows are positions within `load_movies()`, which is also the row order
+    of the content-based index.
+
+    Parameters
+    ----------
+    movies : Pandas DataFrame
+        movieId and title of every movie.
+
+    Notes
+    -----
+    Titles are not unique (e.g. remakes released in the same year). A
+    duplicated title resolves to its first row, like the linear scans it
+    replaces.
+
+    """
+
+    def __init__(self, movies):
+        self.movie_ids = movies['movieId'].to_numpy()
+        self.titles = movies['title'].to_numpy()
+        rows = np.arange(len(movies), dtype=np.int32)
+        # Reversed so that the first row of a duplicated title wins
+        self.title_rows = dict(zip(self.titles[::-1].tolist(), rows[::-1].tolist()))
+        self.id_rows = np.full(int(self.movie_ids.max(initial=0)) + 1, -1, dtype=np.int32)
+        self.id_rows[self.movie_ids] = rows
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def rows_for_titles(self, titles):
+        """Rows of the given titles.
+
+        Raises
+        ------
+        KeyError
+            If a title is not in the catalogue.
+
+        """
+        return np.array([self.title_rows[title] for title in titles], dtype=np.int64)
+
+    def ids_for_titles(self, titles):
+        """Movie IDs of the given titles (see `rows_for_titles`)."""
+        return self.movie_ids[self.rows_for_titles(titles)]
+
+    def rows(self, movie_ids):
+        """Rows of the given movie IDs, or -1 for unknown movies."""
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        known = (movie_ids >= 0) & (movie_ids < len(self.id_rows))
+        rows = np.full(movie_ids.shape, -1, dtype=np.int64)
+        rows[known] = self.id_rows[movie_ids[known]]
+        return rows
+
+    def titles_for_ids(self, movie_ids):
+        """Titles of the given (known) movie IDs."""
+        return self.titles[self.rows(movie_ids)].tolist()
+
+@cached_by_path
+@timed('data.load_catalogue')
+def load_catalogue(path_to_movies=MOVIES_PATH):
+    """Build the movie catalogue index, once per process.
+
+    Parameters
+    ----------
+    path_to_movies : str
+        Relative or absolute path to movie database stored
+        in .csv format.
+
+    Returns
+    -------
+    Catalogue
+        Shared lookup tables between titles, movie IDs and rows.
+
+    """
+    return Catalogue(load_movies(path_to_movies))
+
+def hash_files(paths):
+    """Compute a digest of the contents of a set of files.
+
+    Parameters
+    ----------
+    paths : list[str]
+        Files to hash, in a fixed order.
+
+    Returns
+    -------
+    str
+        Hexadecimal SHA-1 digest of the file contents.
+
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def save_frame(df, path):
+    """Persist a data frame in Feather format.
+
+    Falls back to a pickle when `pyarrow` is not installed.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        Frame to store. The index is not stored.
+    path : str
+        Destination path, without extension.
+
+    Returns
+    -------
+    str
+        Path of the written file.
+
+    """
+    df = df.reset_index(drop=True)
+    try:
+        df.to_feather(path + '.feather')
+        return path + '.feather'
+    except ImportError:
+        df.to_pickle(path + '.pkl')
+        return path + '.pkl'
+
+def load_frame(path):
+    """Load a data frame written by `save_frame`.
+
+    Parameters
+    ----------
+    path : str
+        Path of the stored frame, without extension.
+
+    Returns
+    -------
+    Pandas DataFrame or None
+        The stored frame, or None if it does not exist.
+
+    """
+    if os.path.exists(path + '.feather'):
+        return pd.read_feather(path + '.feather')
+    if os.path.exists(path + '.pkl'):
+        return pd.read_pickle(path + '.pkl')
+    return None
+
+if __name__ == '__main__':
+    convert_movies()
+    convert_ratings()
+    print(f"Binary cache written next to: {MOVIES_PATH} and {RATINGS_PATH}")
@@ -0,0 +1,242 @@
+"""
+
+    Timing and memory instrumentation of the recommendation pipeline.
+
+    Author: Explore Data Science Academy.
+
+    Description: Stages of the pipeline are wrapped in spans, either with
+    the `span` context manager or the `timed` decorator. While
+    instrumentation is disabled (the default) a span costs one global
+    flag check. Once enabled, with the environment variable
+    `RECOMMENDER_INSTRUMENTATION=1` or `enable()`, every span records its
+    wall time in a latency histogram and, within a `request`, its place in
+    the breakdown of that request. Finished requests are appended as JSON
+    lines to the file named by `RECOMMENDER_METRICS_LOG`, if set, along
+    with a `snapshot` of the counters and histograms at most every
+    `RECOMMENDER_METRICS_INTERVAL` seconds (60 by default) and when the
+    process exits.
+
+"""
+# Instrumentation dependencies
+import os
+import sys
+import json
+import time
+import atexit
+import bisect
+import functools
+import threading
+try:
+    import resource
+except ImportError:
+    # Unix only: peak RSS is not reported on Windows
+    resource = None
+
+# Instrumentation is off unless explicitly enabled
+enabled = os.environ.get('RECOMMENDER_INSTRUMENTATION', '') not in ('', '0')
+LOG_PATH = os.environ.get('RECOMMENDER_METRICS_LOG')
+# Least number of seconds between two snapshots appended to the log
+SNAPSHOT_INTERVAL_S = float(os.environ.get('RECOMMENDER_METRICS_INTERVAL', 60))
+
+# Upper bounds (in milliseconds) of the latency histogram buckets
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500,
+              5000, 10000, float('inf'))
+
+lock = threading.Lock()
+counters = {}
+histograms = {}
+# Breakdown of the last finished request, see `request`
+last_request = None
+# Span stack and request breakdown of the current thread
+local = threading.local()
+# Time the last snapshot was appended to the log, see `log_snapshot`
+last_snapshot = time.monotonic()
+
+def enable(log_path=None):
+    """Turn instrumentation on, optionally logging requests to a file."""
+    global enabled, LOG_PATH
+    enabled = True
+    if log_path is not None:
+        LOG_PATH = log_path
+
+def disable():
+    """Turn instrumentation off. Recorded metrics are kept."""
+    global enabled
+    enabled = False
+
+def peak_rss_mb():
+    """Peak resident set size of the process, in MiB, or None where the
+       platform does not report it.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in KiB elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+def count(name, n=1):
+    """Add `n` to a counter, when instrumentation is enabled."""
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + n
+
+def observe(name, ms):
+    """Record a latency, in milliseconds, in the histogram of `name`."""
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = dict(count=0, sum_ms=0.0,
+                                                buckets=[0] * len(BUCKETS_MS))
+        histogram['count'] += 1
+        histogram['sum_ms'] += ms
+        histogram['buckets'][bisect.bisect_left(BUCKETS_MS, ms)] += 1
+
+class NullSpan:
+    """Span returned while instrumentation is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span:
+    """Time a stage of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, e.g. 'content.merge'.
+
+    """
+
+    __slots__ = ('name', 'start', 'rss', 'slot')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(local, 'stack', None)
+        if stack is None:
+            stack = local.stack = []
+        trace = getattr(local, 'trace', None)
+        # Reserve the place of the span in the request breakdown, so that
+        # parents are listed before their children
+        self.slot = None
+        if trace is not None:
+            self.slot = len(trace)
+            trace.append(None)
+        stack.append(self)
+        self.rss = peak_rss_mb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        ms = (time.perf_counter() - self.start) * 1000
+        rss_mb = peak_rss_mb()
+        if rss_mb is not None:
+            rss_mb -= self.rss
+        local.stack.pop()
+        observe(self.name, ms)
+        if exc_type is not None:
+            count(self.name + '.errors')
+        if self.slot is not None:
+            local.trace[self.slot] = dict(name=self.name, depth=len(local.stack),
+                                          ms=ms, peak_rss_growth_mb=rss_mb)
+        return False
+
+def span(name):
+    """Context manager timing a stage, at (almost) no cost when disabled."""
+    return Span(name) if enabled else NULL_SPAN
+
+def timed(name):
+    """Decorator timing every call of a function as a span named `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class Request(Span):
+    """Root span collecting the breakdown of one request, see `request`."""
+
+    __slots__ = ('outer',)
+
+    def __enter__(self):
+        self.outer = getattr(local, 'trace', None)
+        local.trace = []
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        global last_request
+        trace = dict(request=self.name, time=time.time(),
+                     spans=[entry for entry in local.trace if entry is not None])
+        local.trace = self.outer
+        last_request = trace
+        if LOG_PATH:
+            with lock, open(LOG_PATH, 'a') as f:
+                f.write(json.dumps(trace) + '\n')
+            if time.monotonic() - last_snapshot >= SNAPSHOT_INTERVAL_S:
+                log_snapshot()
+        return False
+
+def request(name):
+    """Context manager recording the breakdown of a request into its spans,
+       at (almost) no cost when disabled.
+    """
+    return Request(name) if enabled else NULL_SPAN
+
+def snapshot():
+    """Counters and latency histograms recorded so far.
+
+    Returns
+    -------
+    dict
+        Counters by name, and for every span name its number of calls,
+        total time and count per bucket of `BUCKETS_MS`.
+
+    """
+    with lock:
+        return dict(buckets_ms=[str(b) for b in BUCKETS_MS],
+                    counters=dict(counters),
+                    histograms={name: dict(h, buckets=list(h['buckets']))
+                                for name, h in histograms.items()})
+
+def write_snapshot(path):
+    """Write `snapshot` to a JSON file."""
+    with open(path, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+
+def log_snapshot():
+    """Append `snapshot` as one JSON line to `LOG_PATH`, if set and
+       anything has been recorded.
+    """
+    global last_snapshot
+    last_snapshot = time.monotonic()
+    if not LOG_PATH or not (counters or histograms):
+        return
+    line = json.dumps(dict(snapshot=snapshot(), time=time.time()))
+    with lock, open(LOG_PATH, 'a') as f:
+        f.write(line + '\n')
+
+# Metrics recorded since the last periodic snapshot are not lost at exit
+atexit.register(log_snapshot)
+
+def quantile(histogram, q):
+    """Upper bound, in milliseconds, of the bucket holding the `q`
+       quantile of a histogram of `snapshot`.
+    """
+    rank = q * histogram['count']
+    total = 0
+    for bound, n in zip(BUCKETS_MS, histogram['buckets']):
+        total += n
+        if total >= rank:
+            return bound
+    return BUCKETS_MS[-1]
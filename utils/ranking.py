@@ -0,0 +1,279 @@
+"""
+
+    Helper functions for ranking similarity scores.
+
+    Author: Explore Data Science Academy.
+
+"""
+# Data handling dependencies
+import itertools
+import numpy as np
+from scipy import sparse
+
+def top_k(scores, k):
+    """Select the positions of the `k` highest scores, best first.
+
+    Uses partial selection (`np.argpartition`) so that only the selected
+    entries are sorted. Two-dimensional input is ranked row by row.
+
+    Parameters
+    ----------
+    scores : array-like
+        Scores to rank along the last axis.
+    k : int
+        Number of positions to return.
+
+    Returns
+    -------
+    numpy.ndarray
+        Positions of the top-k scores in descending score order.
+
+    """
+    scores = np.asarray(scores)
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.intp)
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    part_scores = np.take_along_axis(scores, part, axis=-1)
+    order = np.argsort(-part_scores, axis=-1, kind='stable')
+    return np.take_along_axis(part, order, axis=-1)
+
+def neighbour_table(matrix, k, chunk_size=512, out=None):
+    """Precompute the top-k neighbours of every row of a matrix.
+
+    Similarities are the dot products between rows, so rows should be
+    L2-normalised for cosine similarity. Rows are scored in chunks so that
+    only a `chunk_size` x n block of scores is held in memory at once.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray or scipy.sparse matrix
+        Row vectors to compare, one per item.
+    k : int
+        Number of neighbours to keep per row (the row itself is excluded).
+    chunk_size : int
+        Number of rows scored per block.
+    out : tuple (array-like, array-like), optional
+        Preallocated n x k outputs for the rows and scores, e.g. arrays
+        memory-mapped to disk with `np.lib.format.open_memmap`.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Neighbour rows (int32) and scores (float32), each of shape n x k,
+        sorted by descending score.
+
+    """
+    n = matrix.shape[0]
+    k = min(k, n - 1)
+    if out is None:
+        out = np.empty((n, k), dtype=np.int32), np.empty((n, k), dtype=np.float32)
+    indices, scores = out
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        block = matrix[start:stop] @ matrix.T
+        block = block.toarray() if hasattr(block, 'toarray') else np.array(block)
+        # A movie is not its own neighbour
+        block[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+        top = top_k(block, k)
+        indices[start:stop] = top
+        scores[start:stop] = np.take_along_axis(block, top, axis=1)
+    return indices, scores
+
+def merge_neighbours(indices, scores, exclude=(), n=10):
+    """Merge several neighbour lists into a single ranking.
+
+    A neighbour shared by several lists keeps its best score.
+
+    Parameters
+    ----------
+    indices : array-like
+        Neighbour rows, one list per seed item.
+    scores : array-like
+        Scores matching `indices`.
+    exclude : array-like
+        Rows which may not be returned (e.g. the seed items).
+    n : int
+        Number of neighbours to return.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Best `n` neighbour rows and their scores, best first.
+
+    """
+    indices = np.ravel(indices)
+    scores = np.ravel(scores)
+    order = np.argsort(-scores, kind='stable')
+    indices, scores = indices[order], scores[order]
+    # Keep the first (best scoring) occurrence of every neighbour
+    _, first = np.unique(indices, return_index=True)
+    first.sort()
+    indices, scores = indices[first], scores[first]
+    keep = ~np.isin(indices, exclude)
+    return indices[keep][:n], scores[keep][:n]
+
+def merge_neighbour_batch(indices, scores, seed_rows, n=10):
+    """Merge the neighbour lists of many lists of seed items at once.
+
+    Gives, for every list of seeds, the ranking `merge_neighbours` gives
+    for the neighbours of those seeds, excluding the seeds themselves,
+    with the neighbour rows of the whole batch gathered in one step.
+
+    Parameters
+    ----------
+    indices : numpy.ndarray
+        Neighbour rows of every item, best first, as built by
+        `neighbour_table`.
+    scores : numpy.ndarray
+        Scores matching `indices`.
+    seed_rows : list (array-like)
+        Item rows of every list of seeds.
+    n : int
+        Number of neighbours to return per list.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Best `n` neighbour rows and their scores, best first, one row per
+        list of seeds. Missing neighbours are padded with -1 and -inf.
+
+    """
+    seed_rows = [np.asarray(rows, dtype=np.intp) for rows in seed_rows]
+    lengths = np.array([len(rows) for rows in seed_rows], dtype=np.intp)
+    width = max(lengths.max(initial=0), 1)
+    present = np.arange(width) < lengths[:, None]
+    seeds = np.full(present.shape, -1, dtype=np.intp)
+    seeds[present] = np.concatenate(seed_rows) if seed_rows else []
+    # Neighbour lists of the whole batch, one block of rows per list
+    k = indices.shape[1]
+    items = np.full(present.shape + (k,), -1, dtype=np.intp)
+    values = np.full(present.shape + (k,), -np.inf)
+    items[present] = indices[seeds[present]]
+    values[present] = scores[seeds[present]]
+    # Seeds come first among the entries of their own item, with an
+    # infinite score, so that dropping repeated entries excludes them
+    items = np.concatenate([seeds, items.reshape(len(seeds), -1)], axis=1)
+    values = np.concatenate([np.where(seeds >= 0, np.inf, -np.inf),
+                             values.reshape(len(seeds), -1)], axis=1)
+    position = np.broadcast_to(np.arange(items.shape[1]), items.shape)
+    # Keep the best scoring (then first) entry of every item of a list
+    order = np.lexsort((position, -values, items), axis=-1)
+    items, values = [np.take_along_axis(a, order, axis=-1) for a in (items, values)]
+    position = np.take_along_axis(position, order, axis=-1)
+    repeated = np.zeros(items.shape, dtype=bool)
+    repeated[:, 1:] = items[:, 1:] == items[:, :-1]
+    values[repeated | (items < 0) | (values == np.inf)] = -np.inf
+    # Rank by score, ties in list order, as `merge_neighbours` does
+    order = np.lexsort((position, -values), axis=-1)[:, :n]
+    items, values = [np.take_along_axis(a, order, axis=-1) for a in (items, values)]
+    items[values == -np.inf] = -1
+    return items, values
+
+def seed_matrix(seed_rows, n_cols):
+    """Build a sparse matrix with one row per list of seed items.
+
+    Each seed is weighted by one over the length of its list, so that the
+    product of this matrix with an item-item similarity gives the mean
+    similarity of every item to the seeds of each list.
+
+    Parameters
+    ----------
+    seed_rows : list (array-like)
+        Item rows of every list of seeds. Lists may be empty.
+    n_cols : int
+        Number of items.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        len(seed_rows) x n_cols matrix.
+
+    """
+    lengths = np.array([len(rows) for rows in seed_rows], dtype=np.int64)
+    indices = np.concatenate([np.asarray(rows, dtype=np.int64) for rows in seed_rows]
+                             + [np.empty(0, dtype=np.int64)])
+    data = np.repeat(1 / np.maximum(lengths, 1), lengths).astype(np.float32)
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(lengths), n_cols))
+    matrix.sum_duplicates()
+    return matrix
+
+def batch_top_k(seeds, score, n, invalid=None, aggregate='mean'):
+    """Rank the items for every row of a seed matrix.
+
+    Parameters
+    ----------
+    seeds : scipy.sparse.csr_matrix
+        Seed matrix, see `seed_matrix`.
+    score : callable
+        Function mapping a seed matrix to a dense matrix of scores of the
+        same shape.
+    n : int
+        Number of items to return per row.
+    invalid : numpy.ndarray, optional
+        Boolean mask of the items which may never be returned.
+    aggregate : str
+        'mean' scores every row of `seeds` with a single call of `score`.
+        'max' scores every seed on its own row and keeps the best score of
+        each item per row, as `merge_neighbours` does for one list of
+        seeds, at the cost of a score block per seed instead of per row.
+
+    Returns
+    -------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Best `n` item rows and their scores for every row of `seeds`,
+        best first. Rows without seeds, or with fewer than `n` items to
+        return, are padded with -1 and -inf.
+
+    """
+    counts = np.diff(seeds.indptr)
+    if aggregate == 'max':
+        singles = sparse.csr_matrix((np.ones(len(seeds.indices), dtype=np.float32), seeds.indices,
+                                     np.arange(len(seeds.indices) + 1)),
+                                    shape=(len(seeds.indices), seeds.shape[1]))
+        per_seed = np.asarray(score(singles), dtype=np.float32)
+        block = np.full(seeds.shape, -np.inf, dtype=np.float32)
+        if len(seeds.indices):
+            block[counts > 0] = np.maximum.reduceat(per_seed, seeds.indptr[:-1][counts > 0],
+                                                    axis=0)
+    else:
+        block = np.asarray(score(seeds), dtype=np.float32)
+    # Seeds are not recommended back
+    block[np.repeat(np.arange(seeds.shape[0]), counts), seeds.indices] = -np.inf
+    block[counts == 0] = -np.inf
+    if invalid is not None:
+        block[:, invalid] = -np.inf
+    top = top_k(block, n)
+    top_scores = np.take_along_axis(block, top, axis=1)
+    top[~np.isfinite(top_scores)] = -1
+    return top, top_scores
+
+def stream_top_k(seed_rows, n_cols, score, n, invalid=None, chunk_size=256, aggregate='mean'):
+    """Rank the items for many lists of seeds, one chunk of lists at a time.
+
+    Only one chunk of seed lists and its `chunk_size` x n_cols block of
+    scores are held in memory at once, so `seed_rows` may be a generator
+    over any number of lists.
+
+    Parameters
+    ----------
+    seed_rows : iterable (array-like)
+        Item rows of every list of seeds.
+    n_cols, score, n, invalid, aggregate
+        See `seed_matrix` and `batch_top_k`.
+    chunk_size : int
+        Number of seed lists ranked per chunk.
+
+    Yields
+    ------
+    tuple (numpy.ndarray, numpy.ndarray)
+        Result of `batch_top_k` for the next chunk of seed lists.
+
+    """
+    seed_rows = iter(seed_rows)
+    while True:
+        chunk = list(itertools.islice(seed_rows, chunk_size))
+        if not chunk:
+            return
+        yield batch_top_k(seed_matrix(chunk, n_cols), score, n, invalid, aggregate)
@@ -0,0 +1,158 @@
+"""
+
+    Process-wide registry of lazily loaded resources.
+
+    Author: Explore Data Science Academy.
+
+"""
+# Registry dependencies
+import sys
+import functools
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.instrumentation import span
+
+class Resource:
+    """A value loaded on first use and shared by every session and rerun.
+
+    Parameters
+    ----------
+    name : str
+        Name of the resource within the registry.
+    loader : callable
+        Zero-argument function returning the value.
+
+    """
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.state = 'pending'
+        self.error = None
+        # One-element tuple holding the value once loaded, replaced as a
+        # whole so that lock-free readers never see a half-reset resource
+        self.loaded = None
+
+    def get(self):
+        """Return the value, loading it if needed.
+
+        Concurrent callers wait for a single load. A failed load is retried
+        by the next caller, and so is a load returning None (e.g. an index
+        file not built yet), so that a file built later is picked up.
+        """
+        loaded = self.loaded
+        if loaded is not None:
+            return loaded[0]
+        with self.lock:
+            if self.loaded is not None:
+                return self.loaded[0]
+            self.state = 'loading'
+            try:
+                with span('load.' + self.name):
+                    value = self.loader()
+            except Exception as error:
+                self.state, self.error = 'failed', error
+                raise
+            if value is not None:
+                self.loaded = (value,)
+            self.state, self.error = 'ready', None
+            return value
+
+    def invalidate(self):
+        """Drop the loaded value, so that the next caller reloads it.
+
+        Callers already holding the value keep using it.
+        """
+        with self.lock:
+            self.loaded = None
+            self.state = 'pending'
+            self.error = None
+
+# Every registered resource, by name
+registry = {}
+
+def resource(name):
+    """Register a zero-argument loader as a lazily loaded resource.
+
+    The decorated function returns the shared value, loading it on the
+    first call. Like `functools.lru_cache`, it exposes `cache_clear`.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the resource.
+
+    """
+    def decorator(loader):
+        shared = Resource(name, loader)
+        registry[name] = shared
+
+        @functools.wraps(loader)
+        def get():
+            return shared.get()
+        get.resource = shared
+        get.cache_clear = shared.invalidate
+        return get
+    return decorator
+
+def status():
+    """Loading state ('pending', 'loading', 'ready' or 'failed') of every
+       registered resource.
+    """
+    return {name: shared.state for name, shared in registry.items()}
+
+# Background loading of resource groups, see `preload`
+preload_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='preload')
+# Module and loading future of every submitted group
+preload_groups = {}
+preload_lock = threading.Lock()
+
+def load_group(module):
+    """Import a module and load the resources listed in its `PRELOAD`."""
+    module = importlib.import_module(module)
+    for name in module.PRELOAD:
+        registry[name].get()
+
+def preload(group, module):
+    """Start loading a module's resources in a background thread.
+
+    Safe to call on every rerun of the app: each group is only submitted
+    once per process.
+
+    Parameters
+    ----------
+    group : str
+        Name under which the readiness is reported.
+    module : str
+        Module to import, listing the names of its resources to load in
+        a `PRELOAD` attribute.
+
+    """
+    with preload_lock:
+        if group not in preload_groups:
+            preload_groups[group] = module, preload_pool.submit(load_group, module)
+
+def readiness(group):
+    """Loading state ('pending', 'loading', 'ready' or 'failed') of a group
+       submitted with `preload`.
+
+    Once the background load has finished, the state follows the current
+    state of the resources of the group, so that a resource loaded on
+    demand after a failed preload is reported as ready.
+    """
+    if group not in preload_groups:
+        return 'pending'
+    module, future = preload_groups[group]
+    if not future.done():
+        return 'loading'
+    module = sys.modules.get(module)
+    if module is None:
+        # The module itself failed to import
+        return 'failed'
+    states = {registry[name].state for name in module.PRELOAD}
+    for state in ('failed', 'loading', 'pending'):
+        if state in states:
+            return state
+    return 'ready'
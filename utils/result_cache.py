@@ -0,0 +1,164 @@
+"""
+
+    Result caching for the recommender entry points.
+
+    Author: Explore Data Science Academy.
+
+"""
+# Caching dependencies
+import os
+import json
+import time
+import sqlite3
+import inspect
+import functools
+import threading
+from collections import OrderedDict
+from utils.instrumentation import count
+
+# Optional on-disk store shared across restarts (e.g. resources/models/results.db)
+CACHE_PATH = os.environ.get('RECOMMENDER_CACHE_PATH')
+CACHE_SIZE = 4096
+CACHE_TTL = 24 * 60 * 60
+
+class RecommendationCache:
+    """Bounded LRU cache of recommendation lists with expiry.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of results kept in memory.
+    ttl : float
+        Seconds after which a cached result expires.
+    path : str, optional
+        SQLite database backing the in-memory cache, so that results
+        survive restarts and are shared between processes.
+
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL, path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS results '
+                            '(key TEXT PRIMARY KEY, expires REAL, value TEXT)')
+            self.db.commit()
+
+    @staticmethod
+    def key(algorithm, movie_list, top_n, version='', options=None):
+        """Order-insensitive key of a recommendation request."""
+        return json.dumps([algorithm, sorted(movie_list), top_n, version]
+                          + ([options] if options else []))
+
+    def get(self, key):
+        """Look up a cached result.
+
+        Returns
+        -------
+        list or None
+            The cached recommendations, or None on a miss.
+
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if self.db is not None:
+                row = self.db.execute('SELECT expires, value FROM results WHERE key = ?',
+                                      (key,)).fetchone()
+                if row is not None and row[0] > now:
+                    self.store(key, (row[0], json.loads(row[1])))
+                    self.hits += 1
+                    return self.entries[key][1]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """Cache a result."""
+        expires = time.time() + self.ttl
+        value = list(value)
+        with self.lock:
+            self.store(key, (expires, value))
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                                (key, expires, json.dumps(value)))
+                self.db.commit()
+
+    def store(self, key, entry):
+        """Insert an in-memory entry, evicting the least recently used."""
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached result and reset the counters."""
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+            if self.db is not None:
+                self.db.execute('DELETE FROM results')
+                self.db.commit()
+
+    def stats(self):
+        """Hit/miss counters and the number of results held in memory."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+# Process-wide cache shared by all recommenders
+recommendation_cache = RecommendationCache(path=CACHE_PATH)
+
+def model_version(paths):
+    """Identify the version of a model by the modification times of the
+       files it is loaded from. Missing files are skipped.
+    """
+    return '|'.join(str(os.stat(path).st_mtime_ns) for path in paths if os.path.exists(path))
+
+def cached_recommendations(algorithm, version=lambda: ''):
+    """Cache the results of a recommender entry point.
+
+    The wrapped function keeps its name and `(movie_list, top_n=10)`
+    signature. Requests for the same set of movies, in any order, are
+    served from `recommendation_cache` until the model version changes.
+    Further arguments of the function (e.g. blend weights), passed by
+    position or by name, are part of the key with their defaults filled
+    in.
+
+    Parameters
+    ----------
+    algorithm : str
+        Name of the recommender, part of the cache key.
+    version : callable
+        Returns the current model version, part of the cache key.
+
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(movie_list, top_n=10, *args, **options):
+            # Further arguments by name, so that every way of passing them
+            # shares one cache entry
+            bound = signature.bind(movie_list, top_n, *args, **options)
+            bound.apply_defaults()
+            options = dict(list(bound.arguments.items())[2:])
+            key = recommendation_cache.key(algorithm, movie_list, top_n, version(), options)
+            recommended_movies = recommendation_cache.get(key)
+            if recommended_movies is None:
+                count(f'{algorithm}.cache_misses')
+                recommended_movies = func(movie_list, top_n, **options)
+                recommendation_cache.put(key, recommended_movies)
+            else:
+                count(f'{algorithm}.cache_hits')
+            return list(recommended_movies)
+        return wrapper
+    return decorator